@@ -0,0 +1,189 @@
+import logging
+import os
+import threading
+from os.path import join as path_join, isdir, exists
+
+from worker_conf import CGROUP_ROOT
+
+"""
+Resource usage of containers read directly from the cgroup files, which is much faster than
+docker stats. Both cgroup v1 and v2 (unified hierarchy) are supported, with cgroupfs as well as
+systemd cgroup driver of Docker.
+"""
+
+"""
+Locations of the cgroup of a container relative to the hierarchy (v2) or the controller (v1),
+the first one is used by the cgroupfs driver, the second one by the systemd driver.
+"""
+CGROUP_PATTERNS = ['docker/{}', 'system.slice/docker-{}.scope']
+
+_version = None
+_lock = threading.Lock()
+
+"""
+Descriptors of memory.peak files, on which the peak was reset. Since Linux 6.12 the reset
+is only visible through the descriptor used to do it, so it is kept open until the stats are read.
+"""
+_peak_fds = {}
+
+"""
+CPU usage of the containers at the moment of reset, in nanoseconds.
+"""
+_cpu_baselines = {}
+
+_peak_reset_supported = True
+
+
+class CgroupNotFound(RuntimeError):
+    def __init__(self, *args, **kwargs):
+        RuntimeError.__init__(self, *args, **kwargs)
+
+
+def cgroup_version():
+    global _version
+
+    if _version is None:
+        _version = 2 if exists(path_join(CGROUP_ROOT, 'cgroup.controllers')) else 1
+        logging.info('Using cgroup v{} hierarchy mounted at {}'.format(_version, CGROUP_ROOT))
+
+    return _version
+
+
+def container_cgroup(container_id, controller):
+    """
+    :return path of the cgroup of the container, `controller` matters only for cgroup v1
+    """
+    base = CGROUP_ROOT if cgroup_version() == 2 else path_join(CGROUP_ROOT, controller)
+
+    for pattern in CGROUP_PATTERNS:
+        path = path_join(base, pattern.format(container_id))
+
+        if isdir(path):
+            return path
+
+    raise CgroupNotFound('The {} cgroup of the container {} was not found'.format(controller, container_id))
+
+
+def _read_int(file_name):
+    with open(file_name, 'r') as f:
+        return int(f.read())
+
+
+def _memory_peak_file(container_id):
+    if cgroup_version() == 2:
+        return path_join(container_cgroup(container_id, 'memory'), 'memory.peak')
+
+    return path_join(container_cgroup(container_id, 'memory'), 'memory.max_usage_in_bytes')
+
+
+def _cpu_usage(container_id):
+    """
+    :return CPU time used by the container in nanoseconds or None if it is not available
+    """
+    try:
+        if cgroup_version() == 2:
+            with open(path_join(container_cgroup(container_id, 'cpu'), 'cpu.stat'), 'r') as f:
+                for line in f:
+                    name, value = line.split()
+
+                    if name == 'usage_usec':
+                        return int(value) * 1000
+
+            return None
+
+        return _read_int(path_join(container_cgroup(container_id, 'cpuacct'), 'cpuacct.usage'))
+    except (CgroupNotFound, IOError, ValueError):
+        return None
+
+
+def peak_reset_supported():
+    """
+    :return False if the peak memory usage of containers turned out not to be resettable
+    """
+    return cgroup_version() == 1 or _peak_reset_supported
+
+
+def reset_stats(container_id):
+    """
+    Reset the peak memory usage and remember the current CPU usage of the container,
+    so the stats read later cover only what happened since now.
+    """
+    global _peak_reset_supported
+
+    peak_file = _memory_peak_file(container_id)
+    forget(container_id)
+
+    if cgroup_version() == 1:
+        with open(peak_file, 'w') as f:
+            f.write('0')
+    elif _peak_reset_supported:
+        fd = None
+
+        try:
+            # memory.peak is missing before Linux 5.19 and read-only before Linux 6.12
+            fd = os.open(peak_file, os.O_RDWR)
+            os.write(fd, b'reset')
+        except OSError as e:
+            if fd is not None:
+                os.close(fd)
+
+            _peak_reset_supported = False
+            logging.warning('The kernel does not support resetting memory.peak ({}), '
+                            'peak memory usage will include the start of containers.'.format(e))
+        else:
+            with _lock:
+                _peak_fds[container_id] = fd
+
+    cpu_usage = _cpu_usage(container_id)
+
+    if cpu_usage is not None:
+        with _lock:
+            _cpu_baselines[container_id] = cpu_usage
+
+
+def read_stats(container_id):
+    """
+    Read stats of the container and forget the state kept since `reset_stats`.
+    :return Incomplete statistics in docker.stats() format, unavailable values are None
+    """
+    with _lock:
+        peak_fd = _peak_fds.pop(container_id, None)
+        cpu_baseline = _cpu_baselines.pop(container_id, 0)
+
+    try:
+        if peak_fd is not None:
+            os.lseek(peak_fd, 0, os.SEEK_SET)
+            memory_max_usage = int(os.read(peak_fd, 64))
+        else:
+            memory_max_usage = _read_int(_memory_peak_file(container_id))
+    except (IOError, ValueError):
+        logging.exception('Failed to read peak memory usage of the container {}'.format(container_id))
+        memory_max_usage = None
+    finally:
+        if peak_fd is not None:
+            os.close(peak_fd)
+
+    cpu_usage = _cpu_usage(container_id)
+
+    return {
+        "memory_stats": {
+            "max_usage": memory_max_usage
+        },
+        "cpu_stats": {
+            "cpu_usage": {
+                "total_usage": cpu_usage - cpu_baseline if cpu_usage is not None else None
+            }
+        }
+    }
+
+
+def forget(container_id):
+    """
+    Drop anything what was kept for the container since `reset_stats`.
+    """
+    with _lock:
+        peak_fd = _peak_fds.pop(container_id, None)
+        _cpu_baselines.pop(container_id, None)
+
+    if peak_fd is not None:
+        os.close(peak_fd)
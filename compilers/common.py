@@ -1,11 +1,26 @@
-from os import makedirs, listdir
-from os.path import join as path_join
-from shutil import rmtree
+import hashlib
+import json
+import logging
+from os import makedirs, listdir, walk
+from os.path import join as path_join, relpath
+from shutil import rmtree, copytree
 from requests.exceptions import ReadTimeout
+from dir_cache import DirectoryCache
 from tuples import CompileStatus
-from workdir import internal_path
+from workdir import internal_path, clear_directory, copy_directory_content
 from container import chown_recursive, docker_cli, destroy_container
-from worker_conf import DOCKER_CONTAINER_USER, DOCKER_CONTAINER_GROUP
+from worker_conf import DOCKER_CONTAINER_USER, DOCKER_CONTAINER_GROUP, COMPILE_CACHE_MAX_BYTES, \
+    OBJECT_CACHE_MAX_BYTES
+
+"""
+Results of the compilations, by the hash of everything what could affect them.
+"""
+compile_cache = DirectoryCache('compilation', internal_path('compile_cache'), COMPILE_CACHE_MAX_BYTES)
+
+"""
+Object files of single translation units, shared by all submissions.
+"""
+object_cache = DirectoryCache('object', internal_path('object_cache'), OBJECT_CACHE_MAX_BYTES)
 
 
 class CompilerConfigurationError(RuntimeError):
@@ -64,8 +79,7 @@ def common_compile(container, package_config):
         else:
             status = 'error'
 
-    stdout, stderr = destroy_container(container)
-    return CompileStatus(status, stderr + stdout)
+    return CompileStatus(status, destroy_container(container))
 
 
 def pick_compilation_units(extensions):
@@ -73,3 +87,64 @@ def pick_compilation_units(extensions):
         for ext in extensions:
             if project_file.endswith(ext):
                 yield path_join('/mnt/in', project_file)
+
+
+def hash_files(hasher, root):
+    """
+    Feed names and contents of all files under `root` into `hasher`.
+    """
+    for dir_path, dirs, files in sorted(walk(root)):
+        for file_name in sorted(files):
+            file_path = path_join(dir_path, file_name)
+            hasher.update(relpath(file_path, root).encode('utf-8') + b'\0')
+
+            hasher.update(file_digest(file_path))
+
+
+def file_digest(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def image_digest(image_name):
+    return docker_cli.inspect_image(image_name)['Id']
+
+
+def cached_compile(cache_key, compile_func):
+    """
+    Return the cached result of the compilation identified by `cache_key` and put the cached
+    binaries into work/compile/out. In case of cache miss, `compile_func` is called and its
+    result is stored in the cache, unless the compilation has timed out.
+    """
+    if not compile_cache.enabled():
+        return compile_func()
+
+    entry_path = compile_cache.lookup(cache_key)
+
+    if entry_path:
+        try:
+            with open(path_join(entry_path, 'result.json'), 'r') as f:
+                result = CompileStatus(**json.load(f))
+
+            clear_directory(internal_path('work/compile/out'))
+            copy_directory_content(path_join(entry_path, 'out'), internal_path('work/compile/out'))
+        finally:
+            compile_cache.release(cache_key)
+
+        logging.info('Compilation result was taken from the cache ({hits} hits, {misses} misses).'
+                     .format(**compile_cache.stats()))
+        return result
+
+    result = compile_func()
+
+    if result.status in ['ok', 'error']:
+        def fill(entry_path):
+            copytree(internal_path('work/compile/out'), path_join(entry_path, 'out'))
+
+            with open(path_join(entry_path, 'result.json'), 'w') as f:
+                json.dump(result._asdict(), f)
+
+        compile_cache.store(cache_key, fill)
+        compile_cache.release(cache_key)
+
+    return result
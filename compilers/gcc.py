@@ -1,45 +1,588 @@
+import logging
 import os
-from shutil import copy
+from math import ceil
+from shutil import copy, move
+from uuid import uuid4
 
 from compilers.common import *
 from container import make_container
+from package import package_build_path
+from tuples import CompilationUnit
 
 image_name = "gcc:latest"
 wrapper_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "gcc", "gcc.sh")
+pch_wrapper_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "gcc", "pch.sh")
+unit_extensions = ['.c', '.cpp']
 
 
 def do_prepare():
     common_prepare()
+    prepare_work_directory(internal_path('work/compile/work'))
+    chown_recursive(internal_path('work/compile'), DOCKER_CONTAINER_USER, DOCKER_CONTAINER_GROUP)
 
-    makedirs(internal_path('work/compile/work/opt'))
-    makedirs(internal_path('work/compile/work/src'))
-    makedirs(internal_path('work/compile/work/obj'))
-    makedirs(internal_path('work/compile/work/inject'))
 
-    copy(wrapper_path, internal_path('work/compile/work/gcc.sh'))
-    os.chmod(internal_path('work/compile/work/gcc.sh'), 0o500)
-    chown_recursive(internal_path('work/compile'), DOCKER_CONTAINER_USER, DOCKER_CONTAINER_GROUP)
+def prepare_work_directory(work_path):
+    for name in ['opt', 'src', 'obj', 'inject', 'deps', 'time']:
+        makedirs(os.path.join(work_path, name))
+
+    copy(wrapper_path, os.path.join(work_path, 'gcc.sh'))
+    os.chmod(os.path.join(work_path, 'gcc.sh'), 0o500)
+
+
+def compilation_key(compiler_conf, pack):
+    hasher = hashlib.sha256()
+    hash_files(hasher, internal_path('work/compile/in'))
+
+    for fname in compiler_conf['inject_files'] + package_headers(compiler_conf):
+        hasher.update(fname.encode('utf-8') + b'\0')
+        hasher.update(file_digest(os.path.join(pack.path, fname)))
+
+    hasher.update(json.dumps([
+        compiler_conf['command_line'],
+        compiler_conf['inject_command_line'],
+        compiler_conf['link_command_line'],
+        compiler_conf['strip_command_line'],
+        compiler_conf['precompiled_headers'],
+        compiler_conf['limits']
+    ], sort_keys=True).encode('utf-8'))
+    hasher.update(toolchain_digest().encode('utf-8'))
+
+    return hasher.hexdigest()
 
 
 def do_compile(compiler_conf, pack):
-    with open(internal_path('work/compile/work/opt/comp_opt'), 'w') as f:
-        f.write(compiler_conf['command_line'])
+    return cached_compile(compilation_key(compiler_conf, pack), lambda: compile_in_container(compiler_conf, pack))
 
-    with open(internal_path('work/compile/work/opt/inject_comp_opt'), 'w') as f:
-        f.write(compiler_conf['inject_command_line'])
 
-    with open(internal_path('work/compile/work/opt/link_opt'), 'w') as f:
+def compile_in_container(compiler_conf, pack):
+    pch_path = precompiled_headers(compiler_conf, pack)
+    objects_path, failure = inject_objects(compiler_conf, pack, pch_path)
+
+    if failure:
+        return failure
+
+    work_path = internal_path('work/compile/work')
+    # injected files are still needed for the headers, but their objects are already built
+    copy_inject_files(work_path, compiler_conf, pack)
+    copy_directory_content(objects_path, os.path.join(work_path, 'obj'))
+
+    toolchain = toolchain_digest()
+    roots = dependency_roots(pch_path)
+    units = []
+    cached_units = []
+
+    for unit in compilation_units('src', internal_path('work/compile/in')):
+        if object_cache.enabled() and restore_object(object_key(compiler_conf, unit, toolchain), unit, roots):
+            cached_units.append(unit)
+        else:
+            units.append(unit)
+
+    jobs = write_options(work_path, compiler_conf, pch_path, units)
+    chown_recursive(work_path, DOCKER_CONTAINER_USER, DOCKER_CONTAINER_GROUP)
+
+    container = make_container(image_name, ['/mnt/work/gcc.sh'], compile_binds(common_binds(), pch_path),
+                               common_host_config(compiler_conf))
+    # TODO check exit code to determine possible errors
+    result = common_compile(container, compiler_conf)
+
+    timings = read_timings(work_path, units)
+
+    if object_cache.enabled():
+        for unit in units:
+            if timings.get(unit.object, (None,))[0] == 'ok':
+                store_object(object_key(compiler_conf, unit, toolchain), unit, roots)
+
+    log_timings(units, timings, jobs, len(cached_units))
+    return result
+
+
+def compile_binds(binds, pch_path):
+    if pch_path:
+        binds[pch_path] = {
+            "bind": "/mnt/pch",
+            "mode": "ro"
+        }
+
+    return binds
+
+
+def copy_inject_files(work_path, compiler_conf, pack):
+    for fname in compiler_conf['inject_files']:
+        copy(os.path.join(pack.path, fname), os.path.join(work_path, 'inject', fname))
+
+
+def write_options(work_path, compiler_conf, pch_path, units, objects_only=False):
+    """
+    Write the options and the list of units for gcc.sh.
+    :return number of parallel jobs
+    """
+    src_opt_prefix = ''
+    inject_opt_prefix = ''
+
+    if pch_path:
+        # gcc looks for <header>.gch in each include directory before the header itself
+        src_opt_prefix = '-I/mnt/pch/src '
+        inject_opt_prefix = '-I/mnt/pch/{} '.format('inject' if os.path.isdir(os.path.join(pch_path, 'inject'))
+                                                     else 'src')
+
+    with open(os.path.join(work_path, 'opt/comp_opt'), 'w') as f:
+        f.write(src_opt_prefix + compiler_conf['command_line'])
+
+    with open(os.path.join(work_path, 'opt/inject_comp_opt'), 'w') as f:
+        f.write(inject_opt_prefix + compiler_conf['inject_command_line'])
+
+    with open(os.path.join(work_path, 'opt/link_opt'), 'w') as f:
         f.write(compiler_conf['link_command_line'])
 
-    with open(internal_path('work/compile/work/opt/strip_opt'), 'w') as f:
+    with open(os.path.join(work_path, 'opt/strip_opt'), 'w') as f:
         f.write(compiler_conf['strip_command_line'])
 
+    jobs = max(1, min(len(units), ceil(compiler_conf['limits']['cpu_quota'] / compiler_conf['limits']['cpu_period'])))
+
+    with open(os.path.join(work_path, 'opt/units'), 'w') as f:
+        for unit in units:
+            f.write('{}\t{}\t{}\n'.format(*unit))
+
+    with open(os.path.join(work_path, 'opt/jobs'), 'w') as f:
+        f.write(str(jobs))
+
+    if objects_only:
+        open(os.path.join(work_path, 'opt/objects_only'), 'w').close()
+
+    return jobs
+
+
+def log_timings(units, timings, jobs, cached_count):
+    logging.info('Compiled {} translation units using {} jobs, {} taken from the object cache'
+                 .format(len(units), jobs, cached_count))
+
+    for unit in units:
+        if unit.object in timings:
+            logging.info('{} {}: {}, {} ms'.format(unit.kind, unit.path, *timings[unit.object]))
+        else:
+            logging.info('{} {}: not finished'.format(unit.kind, unit.path))
+
+
+def inject_objects(compiler_conf, pack, pch_path):
+    """
+    Get the object files of the injected files, they are compiled once for each version
+    of the package, compiler options and image and kept with the package.
+    :return (host path of the directory with the object files, CompileStatus if they could not be compiled)
+    """
+    hasher = hashlib.sha256()
+
     for fname in compiler_conf['inject_files']:
-        copy(os.path.join(pack.path, fname), internal_path(os.path.join('work/compile/work/inject', fname)))
+        hasher.update(fname.encode('utf-8') + b'\0')
+        hasher.update(file_digest(os.path.join(pack.path, fname)))
 
-    container = make_container(image_name, ['/mnt/work/gcc.sh'], common_binds(), common_host_config(compiler_conf))
-    # TODO check exit code to determine possible errors
-    return common_compile(container, compiler_conf)
+    hasher.update(json.dumps([
+        compiler_conf['inject_command_line'],
+        os.path.basename(pch_path) if pch_path else None
+    ]).encode('utf-8'))
+    hasher.update(toolchain_digest().encode('utf-8'))
+
+    objects_path = package_build_path(pack, 'inject-' + hasher.hexdigest())
+
+    if not os.path.isdir(objects_path):
+        result = build_inject_objects(compiler_conf, pack, pch_path, objects_path)
+
+        if result.status == 'timeout':
+            return None, result
+
+    if os.path.exists(os.path.join(objects_path, 'failed')):
+        with open(os.path.join(objects_path, 'failed'), 'r') as f:
+            return None, CompileStatus('error', f.read())
+
+    return objects_path, None
+
+
+def build_inject_objects(compiler_conf, pack, pch_path, objects_path):
+    """
+    Compile the injected files with gcc.sh in a separate work directory and move the objects
+    to `objects_path`. Compilation errors are stored there as well, timeouts are not.
+    :return CompileStatus of the compilation
+    """
+    build_path = internal_path('work/compile/inject')
+    work_path = os.path.join(build_path, 'work')
+    rmtree(build_path, ignore_errors=True)
+    makedirs(os.path.join(build_path, 'in'))
+    makedirs(os.path.join(build_path, 'out'))
+    prepare_work_directory(work_path)
+    copy_inject_files(work_path, compiler_conf, pack)
+
+    # object files of injected files are linked after the ones of the submission
+    units = compilation_units('inject', os.path.join(work_path, 'inject'), 'inject-')
+    result = CompileStatus('ok', '')
+
+    if units:
+        logging.info('Compiling injected files of the package {}...'.format(pack.file_name))
+        jobs = write_options(work_path, compiler_conf, pch_path, units, objects_only=True)
+        chown_recursive(build_path, DOCKER_CONTAINER_USER, DOCKER_CONTAINER_GROUP)
+
+        binds = {
+            os.path.join(build_path, 'in'): {
+                "bind": "/mnt/in",
+                "mode": "ro"
+            },
+            work_path: {
+                "bind": "/mnt/work",
+                "mode": "rw"
+            },
+            os.path.join(build_path, 'out'): {
+                "bind": "/mnt/out",
+                "mode": "rw"
+            }
+        }
+        container = make_container(image_name, ['/mnt/work/gcc.sh'], compile_binds(binds, pch_path),
+                                   common_host_config(compiler_conf))
+        result = common_compile(container, compiler_conf)
+        log_timings(units, read_timings(work_path, units), jobs, 0)
+
+    if result.status == 'timeout':
+        rmtree(build_path, ignore_errors=True)
+        return result
+
+    tmp_path = '{}.tmp-{}'.format(objects_path, uuid4().hex)
+
+    if result.status == 'ok':
+        move(os.path.join(work_path, 'obj'), tmp_path)
+    else:
+        makedirs(tmp_path)
+
+        with open(os.path.join(tmp_path, 'failed'), 'w') as f:
+            f.write(result.message)
+
+    try:
+        os.rename(tmp_path, objects_path)
+    except OSError:
+        # some other submission slot was faster
+        rmtree(tmp_path, ignore_errors=True)
+
+    rmtree(build_path, ignore_errors=True)
+    return result
+
+
+def toolchain_digest():
+    hasher = hashlib.sha256()
+    hasher.update(image_digest(image_name).encode('utf-8'))
+    hasher.update(file_digest(wrapper_path))
+    hasher.update(file_digest(pch_wrapper_path))
+    return hasher.hexdigest()
+
+
+def package_headers(compiler_conf):
+    """
+    Precompiled headers which are files of the package, the other ones are written as <header>.
+    """
+    return [header for header in compiler_conf['precompiled_headers']
+            if not (header.startswith('<') and header.endswith('>'))]
+
+
+def precompiled_headers(compiler_conf, pack):
+    """
+    Get the precompiled headers declared by the package, they are built once for each version
+    of the package, compiler options and image and kept with the package.
+    :return host path of the directory with precompiled headers or None if there are none
+    """
+    if not compiler_conf['precompiled_headers']:
+        return None
+
+    kinds = ['src']
+
+    if compiler_conf['inject_command_line'] != compiler_conf['command_line']:
+        kinds.append('inject')
+
+    hasher = hashlib.sha256()
+
+    for fname in compiler_conf['inject_files'] + package_headers(compiler_conf):
+        hasher.update(fname.encode('utf-8') + b'\0')
+        hasher.update(file_digest(os.path.join(pack.path, fname)))
+
+    hasher.update(json.dumps([
+        compiler_conf['command_line'],
+        compiler_conf['inject_command_line'],
+        compiler_conf['precompiled_headers'],
+        kinds
+    ]).encode('utf-8'))
+    hasher.update(toolchain_digest().encode('utf-8'))
+
+    pch_path = package_build_path(pack, 'pch-' + hasher.hexdigest())
+
+    if not os.path.isdir(pch_path):
+        build_precompiled_headers(compiler_conf, pack, kinds, pch_path)
+
+    if os.path.exists(os.path.join(pch_path, 'failed')):
+        return None
+
+    return pch_path
+
+
+def build_precompiled_headers(compiler_conf, pack, kinds, pch_path):
+    """
+    Compile the headers in a separate container and move them to `pch_path`. Failure is
+    remembered there as well, so the compilation is not attempted for every submission.
+    """
+    build_path = internal_path('work/compile/pch')
+    rmtree(build_path, ignore_errors=True)
+    makedirs(os.path.join(build_path, 'hdr'))
+    makedirs(os.path.join(build_path, 'opt'))
+    makedirs(os.path.join(build_path, 'out'))
+
+    # package headers may include the injected files, so all of them are put together
+    for fname in set(compiler_conf['inject_files'] + package_headers(compiler_conf)):
+        if not os.path.isfile(os.path.join(pack.path, fname)):
+            raise CompilerConfigurationError('Precompiled header {} is not a file of the package'.format(fname))
+
+        makedirs(os.path.dirname(os.path.join(build_path, 'hdr', fname)), exist_ok=True)
+        copy(os.path.join(pack.path, fname), os.path.join(build_path, 'hdr', fname))
+
+    headers = []
+
+    for header in compiler_conf['precompiled_headers']:
+        if header in package_headers(compiler_conf):
+            headers.append(header)
+            continue
+
+        # a system header is precompiled through a header including it
+        header = header[1:-1]
+        makedirs(os.path.dirname(os.path.join(build_path, 'hdr', header)), exist_ok=True)
+
+        with open(os.path.join(build_path, 'hdr', header), 'w') as f:
+            f.write('#include <{}>\n'.format(header))
+
+        headers.append(header)
+
+    with open(os.path.join(build_path, 'opt', 'comp_opt'), 'w') as f:
+        f.write(compiler_conf['command_line'])
+
+    with open(os.path.join(build_path, 'opt', 'inject_comp_opt'), 'w') as f:
+        f.write(compiler_conf['inject_command_line'])
+
+    with open(os.path.join(build_path, 'opt', 'headers'), 'w') as f:
+        for kind in kinds:
+            for header in headers:
+                f.write('{}\t{}\n'.format(kind, header))
+
+    copy(pch_wrapper_path, os.path.join(build_path, 'pch.sh'))
+    os.chmod(os.path.join(build_path, 'pch.sh'), 0o500)
+    chown_recursive(build_path, DOCKER_CONTAINER_USER, DOCKER_CONTAINER_GROUP)
+
+    logging.info('Building precompiled headers of the package {}...'.format(pack.file_name))
+    binds = {
+        build_path: {
+            "bind": "/mnt/build",
+            "mode": "rw"
+        }
+    }
+    container = make_container(image_name, ['/mnt/build/pch.sh'], binds, common_host_config(compiler_conf))
+    result = common_compile(container, compiler_conf)
+
+    tmp_path = '{}.tmp-{}'.format(pch_path, uuid4().hex)
+
+    if result.status == 'ok':
+        move(os.path.join(build_path, 'out'), tmp_path)
+    else:
+        logging.warning('Failed to build precompiled headers, they will not be used: {}'.format(result.message))
+        makedirs(tmp_path)
+
+        with open(os.path.join(tmp_path, 'failed'), 'w') as f:
+            f.write(result.message)
+
+    try:
+        os.rename(tmp_path, pch_path)
+    except OSError:
+        # some other submission slot was faster
+        rmtree(tmp_path, ignore_errors=True)
+
+    rmtree(build_path, ignore_errors=True)
+
+
+def dependency_roots(pch_path):
+    """
+    Directories of the compiler container, where the dependencies of translation units may be found,
+    with the corresponding host directories.
+    """
+    roots = [
+        ('/mnt/work/src', internal_path('work/compile/in')),
+        ('/mnt/in', internal_path('work/compile/in')),
+        ('/mnt/work/inject', internal_path('work/compile/work/inject'))
+    ]
+
+    if pch_path:
+        roots.append(('/mnt/pch', pch_path))
+
+    return roots
+
+
+def compilation_units(kind, root, prefix=''):
+    """
+    Find translation units under `root`. Object files are named by the position of the unit,
+    so they are linked in the same order as before.
+    """
+    units = []
+
+    for dir_path, dirs, files in sorted(os.walk(root)):
+        for fname in sorted(files):
+            base_name, ext = os.path.splitext(fname)
+
+            if ext in unit_extensions:
+                unit_path = os.path.relpath(os.path.join(dir_path, fname), root)
+                units.append(CompilationUnit(kind, unit_path,
+                                             '{}{:04d}-{}.o'.format(prefix, len(units) + 1, base_name)))
+
+    return units
+
+
+def object_key(compiler_conf, unit, toolchain):
+    """
+    Key of the cache entry with object files of the unit, one entry holds a variant for each
+    content of the headers included by the unit.
+    """
+    if unit.kind == 'inject':
+        options = [compiler_conf['inject_command_line']]
+    else:
+        options = [compiler_conf['command_line'], compiler_conf['strip_command_line']]
+
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([unit.kind, unit.path, options, toolchain]).encode('utf-8'))
+    hasher.update(file_digest(unit_host_path(unit)))
+    return hasher.hexdigest()
+
+
+def unit_host_path(unit):
+    if unit.kind == 'inject':
+        return internal_path(os.path.join('work/compile/work/inject', unit.path))
+
+    return internal_path(os.path.join('work/compile/in', unit.path))
+
+
+def dependency_host_path(dependency, unit, roots):
+    """
+    Translate the path of a dependency, as written by the compiler, to the host path.
+    :return the host path or None if the dependency is outside of known directories
+    """
+    work_dir = '/mnt/work/inject' if unit.kind == 'inject' else '/mnt/work/src'
+    container_path = os.path.normpath(os.path.join(work_dir, dependency))
+
+    for container_root, host_root in roots:
+        if container_path == container_root or container_path.startswith(container_root + '/'):
+            return host_root + container_path[len(container_root):]
+
+    return None
+
+
+def dependencies_digest(dependencies, unit, roots):
+    """
+    :return hash of the current content of the dependencies or None if some of them is missing
+    """
+    hasher = hashlib.sha256()
+
+    for dependency in dependencies:
+        host_path = dependency_host_path(dependency, unit, roots)
+
+        if host_path is None or not os.path.isfile(host_path):
+            return None
+
+        hasher.update(dependency.encode('utf-8') + b'\0')
+        hasher.update(file_digest(host_path))
+
+    return hasher.hexdigest()
+
+
+def read_dependencies(unit):
+    """
+    Parse the dependency file written by gcc -MMD.
+    :return list of dependencies or None if the file is missing or could not be understood
+    """
+    try:
+        with open(internal_path(os.path.join('work/compile/work/deps', unit.object + '.d')), 'r') as f:
+            content = f.read()
+    except FileNotFoundError:
+        return None
+
+    if '\\ ' in content or '$$' in content:
+        # escaped file names are not supported
+        return None
+
+    target, sep, dependencies = content.replace('\\\n', ' ').partition(': ')
+
+    if not sep:
+        return None
+
+    return dependencies.split()
+
+
+def read_timings(work_path, units):
+    """
+    :return dict from object file name to (status, time in ms) for every finished unit
+    """
+    timings = {}
+
+    for unit in units:
+        try:
+            with open(os.path.join(work_path, 'time', unit.object), 'r') as f:
+                status, time = f.read().split()
+        except (FileNotFoundError, ValueError):
+            continue
+
+        timings[unit.object] = (status, int(time))
+
+    return timings
+
+
+def restore_object(key, unit, roots):
+    """
+    Copy the cached object file of the unit into work/compile/work/obj if there is one compiled
+    with the same content of all dependencies.
+    """
+    entry_path = object_cache.lookup(key)
+
+    if not entry_path:
+        return False
+
+    try:
+        for variant_file in sorted(os.listdir(entry_path)):
+            if not variant_file.endswith('.deps'):
+                continue
+
+            variant = variant_file[:-len('.deps')]
+
+            with open(os.path.join(entry_path, variant_file), 'r') as f:
+                dependencies = json.load(f)
+
+            if dependencies_digest(dependencies, unit, roots) == variant:
+                copy(os.path.join(entry_path, variant + '.o'),
+                     internal_path(os.path.join('work/compile/work/obj', unit.object)))
+                return True
+    finally:
+        object_cache.release(key)
+
+    return False
+
+
+def store_object(key, unit, roots):
+    dependencies = read_dependencies(unit)
+
+    if dependencies is None:
+        return
+
+    variant = dependencies_digest(dependencies, unit, roots)
+
+    if variant is None:
+        return
+
+    def fill(entry_path):
+        # the .deps file is written last, a variant without it is never used
+        tmp_path = os.path.join(entry_path, '.tmp-{}'.format(uuid4().hex))
+        copy(internal_path(os.path.join('work/compile/work/obj', unit.object)), tmp_path)
+        os.rename(tmp_path, os.path.join(entry_path, variant + '.o'))
+
+        with open(tmp_path, 'w') as f:
+            json.dump(dependencies, f)
+
+        os.rename(tmp_path, os.path.join(entry_path, variant + '.deps'))
+
+    object_cache.extend(key, fill)
 
 
 __plugin__ = {
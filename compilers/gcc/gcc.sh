@@ -1,62 +1,71 @@
 #!/bin/bash
 
 cd /mnt/work
-cp -r /mnt/in/* /mnt/work/src/
+[ -n "$(ls -A /mnt/in)" ] && cp -r /mnt/in/* /mnt/work/src/
 
-COMP_OPT=$(cat opt/comp_opt)
-INJECT_COMP_OPT=$(cat opt/inject_comp_opt)
+export COMP_OPT=$(cat opt/comp_opt)
+export INJECT_COMP_OPT=$(cat opt/inject_comp_opt)
+export STRIP_OPT=$(cat opt/strip_opt)
 LINK_OPT=$(cat opt/link_opt)
-STRIP_OPT=$(cat opt/strip_opt)
-SEQ=1
+JOBS=$(cat opt/jobs)
 
-cd src
-find . -type f -name "*.cpp" -o -type f -name "*.c" | while read -r FNAME
-do
-        BASENAME="${FNAME##*/}"
-        TARGET_FNAME="${BASENAME%.*}.$SEQ.o"
-        g++ $COMP_OPT -c "$FNAME" -o "../obj/$TARGET_FNAME"
+# each line of opt/units describes one translation unit: kind<TAB>path<TAB>object file name
+# units which were taken from the object cache are already in obj/ and are not listed
+compile_unit() {
+        IFS=$'\t' read -r KIND FNAME TARGET_FNAME <<< "$1"
+        LOG="/mnt/work/log/$TARGET_FNAME.log"
+        START=$(date +%s%N)
 
-        if [ $? -ne 0 ]
+        if [ "$KIND" == "inject" ]
         then
-                echo gcc failed >&2
-                exit 1
+                cd /mnt/work/inject
+                OPT=$INJECT_COMP_OPT
+        else
+                cd /mnt/work/src
+                OPT=$COMP_OPT
         fi
 
-        if [ "$STRIP_OPT" != "" ]
+        g++ $OPT -MMD -MF "/mnt/work/deps/$TARGET_FNAME.d" -c "$FNAME" -o "/mnt/work/obj/$TARGET_FNAME" > "$LOG" 2>&1
+        STATUS=$?
+
+        if [ $STATUS -eq 0 ] && [ "$KIND" == "src" ] && [ "$STRIP_OPT" != "" ]
         then
-                strip $STRIP_OPT "../obj/$TARGET_FNAME"
+                strip $STRIP_OPT "/mnt/work/obj/$TARGET_FNAME" >> "$LOG" 2>&1
+                STATUS=$?
+        fi
+
+        END=$(date +%s%N)
 
-                if [ $? -ne 0 ]
-                then
-                        echo strip failed >&2
-                        exit 2
-                fi
+        if [ $STATUS -eq 0 ]
+        then
+                echo "ok $(( (END - START) / 1000000 ))" > "/mnt/work/time/$TARGET_FNAME"
+        else
+                echo "error $(( (END - START) / 1000000 ))" > "/mnt/work/time/$TARGET_FNAME"
+                return 1
         fi
+}
+export -f compile_unit
 
-        SEQ=$((SEQ+1))
-done
+mkdir -p log deps time
+
+xargs -r -d '\n' -n 1 -P "$JOBS" bash -c 'compile_unit "$1"' _ < opt/units
 EXIT_CODE=$?
-[ $EXIT_CODE -ne 0 ] && exit $EXIT_CODE;
 
-cd ../inject
-find . -type f | while read -r FNAME
+# print compiler messages in the order of units, not in the order of completion
+cut -f 3 opt/units | while read -r TARGET_FNAME
 do
-        BASENAME="${FNAME##*/}"
-        TARGET_FNAME="${BASENAME%.*}.$SEQ.o"
-        g++ $INJECT_COMP_OPT -c "$FNAME" -o "../obj/$TARGET_FNAME"
+        cat "log/$TARGET_FNAME.log" >&2 2> /dev/null
+done
 
-        if [ $? -ne 0 ]
-        then
-                echo gcc failed >&2
-                exit 2
-        fi
+if [ $EXIT_CODE -ne 0 ]
+then
+        echo gcc failed >&2
+        exit 1
+fi
 
-        SEQ=$((SEQ+1))
-done
-EXIT_CODE=$?
-[ $EXIT_CODE -ne 0 ] && exit $EXIT_CODE;
+# injected files of a package are compiled separately and linked with each submission later
+[ -f opt/objects_only ] && exit 0
 
-cd ..
 g++ $LINK_OPT obj/*.o -o prog
 
 if [ $? -ne 0 ]
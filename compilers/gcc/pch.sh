@@ -0,0 +1,27 @@
+#!/bin/bash
+
+# each line of opt/headers describes one precompiled header: kind<TAB>header path relative to hdr/
+# the header is compiled with the options of the units of that kind into out/<kind>/<header>.gch
+cd /mnt/build/hdr
+STATUS=0
+
+while IFS=$'\t' read -r KIND HEADER
+do
+        if [ "$KIND" == "inject" ]
+        then
+                OPT=$(cat ../opt/inject_comp_opt)
+        else
+                OPT=$(cat ../opt/comp_opt)
+        fi
+
+        mkdir -p "$(dirname "../out/$KIND/$HEADER")"
+        g++ $OPT -x c++-header "$HEADER" -o "../out/$KIND/$HEADER.gch"
+
+        if [ $? -ne 0 ]
+        then
+                echo "precompiling $HEADER failed" >&2
+                STATUS=1
+        fi
+done < ../opt/headers
+
+exit $STATUS
@@ -1,6 +1,7 @@
 from itertools import cycle, chain
 import json
 import logging
+import threading
 
 import inspect
 import datetime
@@ -9,14 +10,18 @@ import sys
 
 from docker import utils as docker_utils
 from docker.errors import APIError
-from time import sleep, time
-from os import walk, chown, makedirs
+from time import sleep, time, monotonic
+from os import walk, chown, makedirs, open as os_open, write as os_write, close as os_close, O_WRONLY, O_NONBLOCK
 from os.path import exists as path_exists, join as path_join
-from shutil import getpwnam, getgrnam
+from queue import Queue, Empty
+from shutil import getpwnam, getgrnam, rmtree
+import cgroup
 import plugin_loader
-from worker_conf import DOCKER_CONF, DOCKER_CONTAINER_USER, INSTANCE_NAME, NETWORKING_CONF
+from fs_watch import wait_for_file, WatchNotAvailable
+from worker_conf import DOCKER_CONF, DOCKER_CONTAINER_USER, INSTANCE_NAME, NETWORKING_CONF, CONTAINER_POOL_SIZE, \
+    CONTAINER_POOL_IDLE_SECONDS, SUBMISSION_SLOTS, TEST_SLOTS
 
-from workdir import internal_path
+from workdir import internal_path, slot_name, get_slot, set_slot
 
 """
 Global instance of Docker client.
@@ -28,6 +33,11 @@ Global network name
 """
 network_name = "{}-{}".format(INSTANCE_NAME, NETWORKING_CONF['network_name'])
 
+"""
+Label which is attached to the containers created for the warm container pool
+"""
+pool_label = "algochecker-{}-pool".format(INSTANCE_NAME)
+
 
 class PluginError(RuntimeError):
     def __init__(self, message, plugin_path, **kwargs):
@@ -36,12 +46,26 @@ class PluginError(RuntimeError):
         self.plugin_path = plugin_path
 
 
+"""
+At most this many bytes of logs are fetched from a container.
+"""
+MAX_LOG_BYTES = 64 * 1024
+
+
 class QuickStatsNotAvailable(RuntimeError):
     def __init__(self, *args, **kwargs):
         RuntimeError.__init__(self, *args, **kwargs)
 
 
-def make_container(image, command, binds, host_config, **kwargs):
+def make_container(image, command, binds, host_config, pooled=False, **kwargs):
+    labels = {
+        "algochecker-{}".format(INSTANCE_NAME): "",
+        "algochecker-slot": slot_name()
+    }
+
+    if pooled:
+        labels[pool_label] = ""
+
     return docker_cli.create_container(
         image=image,
         command=command,
@@ -50,7 +74,7 @@ def make_container(image, command, binds, host_config, **kwargs):
             binds=binds,
             **host_config
         ),
-        labels=["algochecker-{}".format(INSTANCE_NAME)],
+        labels=labels,
         **kwargs
     )
 
@@ -59,15 +83,48 @@ def inspect_container(container):
     return docker_cli.inspect_container(container)
 
 
-def destroy_container(container):
+def destroy_container(container, collect_logs=True):
+    """
+    Stop and remove the container.
+    :return logs of the container (see `container_logs`) or None if `collect_logs` is not set
+    """
     docker_cli.stop(container, timeout=0)
-
-    stdout = docker_cli.logs(container, stdout=True, stderr=False, stream=False, timestamps=False).decode('utf-8')
-    stderr = docker_cli.logs(container, stdout=False, stderr=True, stream=False, timestamps=False).decode('utf-8')
+    logs = container_logs(container) if collect_logs else None
 
     docker_cli.remove_container(container, force=True)
+    _pool_lent.discard(container_id(container))
+    cgroup.forget(container_id(container))
+
+    return logs
 
-    return stdout, stderr
+
+def container_logs(container, max_bytes=MAX_LOG_BYTES):
+    """
+    Fetch stdout and stderr of the container in a single request, as they were interleaved.
+    Only the first `max_bytes` are read, logs are meant for diagnostics and compiler messages.
+    """
+    chunks = []
+    size = 0
+    stream = docker_cli.logs(container, stdout=True, stderr=True, stream=True, follow=False, timestamps=False)
+
+    try:
+        for chunk in stream:
+            chunks.append(chunk[:max_bytes - size])
+            size += len(chunks[-1])
+
+            if size >= max_bytes:
+                break
+    finally:
+        stream.close()
+
+    return b''.join(chunks).decode('utf-8', errors='replace')
+
+
+def container_id(container):
+    if type(container) is dict:
+        return container['Id']
+
+    return container
 
 
 def safe_plugin_call(plugin, func):
@@ -104,11 +161,29 @@ def save_leak_report(container):
     return full_report_path
 
 
-def check_lost_containers(no_header=False):
+def is_lost_container(container, all_slots):
+    labels = container['Labels'] or {}
+
+    # idle containers of the warm pool are not lost, unless they were handed out to some test
+    if pool_label in labels and container['Id'] not in _pool_lent:
+        return False
+
+    return all_slots or labels.get('algochecker-slot', INSTANCE_NAME) == slot_name()
+
+
+def check_lost_containers(no_header=False, all_slots=False):
+    """
+    Find and destroy the containers which were left behind by the current submission slot,
+    or by any slot of this instance if `all_slots` is set.
+    """
     logging.info('Checking lost containers...')
+    # containers which are being removed by the reaper are not lost
+    wait_for_reaper(all_slots)
+
     algo_label = 'algochecker-{}'.format(INSTANCE_NAME)
 
-    lost = (container['Id'] for container in docker_cli.containers(all=True, filters={"label": algo_label}))
+    lost = [container['Id'] for container in docker_cli.containers(all=True, filters={"label": algo_label})
+            if is_lost_container(container, all_slots)]
     saved_reports = []
 
     for container in lost:
@@ -122,6 +197,7 @@ def check_lost_containers(no_header=False):
                       .format(report_path))
         logging.error('Destroying the container...')
         docker_cli.remove_container(container, force=True)
+        _pool_lent.discard(container)
         if not no_header:
             logging.error('-----------------------------')
 
@@ -178,11 +254,17 @@ def check_image_dependencies():
 
 def file_spinlock(file_name, timeout, step=0.01):
     """
-    Run a spinlock, which will last until file with name `file_name` is created.
+    Wait until file with name `file_name` is created.
     Maximal waiting time is determined by `timeout` argument (in seconds).
-    File existence will be checked every `step` seconds.
+    The directory of the file is watched with inotify, only if this is not possible,
+    file existence will be checked every `step` seconds.
     :return True if spinlock was unlocked; False if timeout occurred
     """
+    try:
+        return wait_for_file(file_name, timeout)
+    except WatchNotAvailable as e:
+        logging.debug('Falling back to polling for {}: {}'.format(file_name, e))
+
     elapsed = 0.0
 
     while elapsed < timeout:
@@ -195,6 +277,22 @@ def file_spinlock(file_name, timeout, step=0.01):
     return False
 
 
+def fifo_signal(file_name):
+    """
+    Wake up a wrapper script blocked on reading the FIFO with name `file_name`.
+    The script has to keep the FIFO open already, otherwise RuntimeError is raised.
+    """
+    try:
+        fd = os_open(file_name, O_WRONLY | O_NONBLOCK)
+    except OSError as e:
+        raise RuntimeError('Nobody is waiting on the FIFO {}'.format(file_name)) from e
+
+    try:
+        os_write(fd, b'\n')
+    finally:
+        os_close(fd)
+
+
 def quickly_get_stats(container):
     """
     Cheat method which returns partial stats in the Docker's format without
@@ -203,35 +301,23 @@ def quickly_get_stats(container):
     :param container: Docker container object.
     :return Incomplete statistics in docker.stats() format as described in docker-py docs.
     """
-    if type(container) is dict:
-        container = container['Id']
-
-    file_name = '/sys/fs/cgroup/memory/docker/{}/memory.max_usage_in_bytes'.format(container)
-
     # TODO read /var/lib/docker/containers/{}/config.v2.json - exit code, start time and finish time are there
 
     try:
-        with open(file_name, 'r') as f:
-            memory_max_usage = int(f.read())
-    except IOError:
-        logging.exception('Failed to quickly get container stats. Peak memory usage is not available.')
-        raise QuickStatsNotAvailable()
-
-    return {
-        "memory_stats": {
-            "max_usage": memory_max_usage
-        }
-    }
+        return cgroup.read_stats(container_id(container))
+    except cgroup.CgroupNotFound as e:
+        logging.warning('Failed to quickly get container stats: {}'.format(e))
+        raise QuickStatsNotAvailable() from e
 
 
 def reset_memory_peak(container):
-    if type(container) is dict:
-        container = container['Id']
-
-    file_name = '/sys/fs/cgroup/memory/docker/{}/memory.max_usage_in_bytes'.format(container)
-
-    with open(file_name, 'w') as f:
-        f.write('0')
+    """
+    Reset the peak memory usage and the CPU time reported later by `quickly_get_stats`.
+    """
+    try:
+        cgroup.reset_stats(container_id(container))
+    except cgroup.CgroupNotFound as e:
+        logging.warning('Failed to reset container stats: {}'.format(e))
 
 
 def chown_recursive(path, user, group):
@@ -260,6 +346,240 @@ def shrink_logs(logs, max_lines=250, max_bytes=12288):
     return logs
 
 
+# warm container pool
+
+"""
+Idle containers of the warm pool, grouped by the pool key. Each entry is a PooledContainer,
+which was already created and started and now waits for being handed out to some test.
+"""
+_pool_idle = {}
+_pool_factories = {}
+_pool_lent = set()
+_pool_lock = threading.Lock()
+_pool_refill = Queue()
+_pool_thread = None
+_pool_generation = 0
+_pool_stats = {"hits": 0, "misses": 0}
+
+"""
+When each pool was last asked for a container, by the pool key.
+"""
+_pool_used = {}
+
+"""
+How often (in seconds) the refill thread looks for the pools which are not used anymore.
+"""
+POOL_EXPIRE_CHECK_INTERVAL = 60
+
+
+def _pool_expire():
+    """
+    Destroy the pools which were not asked for a container for CONTAINER_POOL_IDLE_SECONDS,
+    e.g. the pools of the packages with unusual images or limits.
+    """
+    unused_since = monotonic() - CONTAINER_POOL_IDLE_SECONDS
+    entries = []
+
+    with _pool_lock:
+        for key in [key for key, used in _pool_used.items() if used < unused_since]:
+            del _pool_used[key]
+            _pool_factories.pop(key, None)
+            entries += _pool_idle.pop(key, [])
+
+    for entry in entries:
+        _pool_destroy(entry)
+
+
+def _pool_refill_loop():
+    expired = monotonic()
+
+    while True:
+        try:
+            key = _pool_refill.get(timeout=POOL_EXPIRE_CHECK_INTERVAL)
+        except Empty:
+            key = None
+
+        # the pools are expired by this thread, so they are never refilled at the same time
+        if monotonic() - expired >= POOL_EXPIRE_CHECK_INTERVAL:
+            _pool_expire()
+            expired = monotonic()
+
+        if key is None:
+            continue
+
+        with _pool_lock:
+            factory = _pool_factories.get(key)
+            generation = _pool_generation
+            missing = CONTAINER_POOL_SIZE - len(_pool_idle.get(key, []))
+
+        if not factory or missing <= 0:
+            continue
+
+        try:
+            entry = factory()
+        except Exception:
+            logging.exception('Failed to create a container for the warm pool.')
+            continue
+
+        with _pool_lock:
+            if generation == _pool_generation:
+                _pool_idle.setdefault(key, []).append(entry)
+                entry = None
+
+                if missing > 1:
+                    _pool_refill.put(key)
+
+        if entry:
+            # the pool was drained while this container was being created
+            _pool_destroy(entry)
+
+
+def _pool_destroy(entry):
+    try:
+        docker_cli.remove_container(entry.container, force=True)
+    except APIError:
+        logging.exception('Failed to remove pooled container {}.'.format(container_id(entry.container)))
+
+    rmtree(internal_path(entry.location), ignore_errors=True)
+
+
+def pool_acquire(key, factory):
+    """
+    Take a ready container out of the warm pool identified by `key`. The pool is refilled
+    in the background by calling `factory`, which should create and start a new container
+    and return a PooledContainer.
+    :return PooledContainer or None if the pool is empty or disabled.
+    """
+    global _pool_thread
+
+    if CONTAINER_POOL_SIZE <= 0:
+        return None
+
+    # every submission slot has its own pool, so pooled containers are labeled
+    # with the slot which is going to use them
+    slot = get_slot()
+    key = (slot, key)
+
+    def slot_factory():
+        set_slot(slot)
+        return factory()
+
+    with _pool_lock:
+        _pool_factories.setdefault(key, slot_factory)
+        _pool_used[key] = monotonic()
+        idle = _pool_idle.get(key)
+
+        if idle:
+            entry = idle.pop(0)
+            _pool_lent.add(container_id(entry.container))
+            _pool_stats['hits'] += 1
+        else:
+            entry = None
+            _pool_stats['misses'] += 1
+
+        if not _pool_thread:
+            _pool_thread = threading.Thread(target=_pool_refill_loop, name='container-pool', daemon=True)
+            _pool_thread.start()
+
+    _pool_refill.put(key)
+    return entry
+
+
+def pool_drain():
+    """
+    Destroy all idle containers of the warm pool, including the ones which were left
+    by the previous run of this instance.
+    """
+    global _pool_generation
+
+    with _pool_lock:
+        _pool_generation += 1
+        entries = [entry for idle in _pool_idle.values() for entry in idle]
+        _pool_idle.clear()
+        _pool_factories.clear()
+        _pool_used.clear()
+
+    for entry in entries:
+        _pool_destroy(entry)
+
+    for container in docker_cli.containers(all=True, filters={"label": pool_label}):
+        if container['Id'] not in _pool_lent:
+            docker_cli.remove_container(container['Id'], force=True)
+
+    if not _pool_lent:
+        rmtree(internal_path('pool'), ignore_errors=True)
+
+
+def pool_stats():
+    with _pool_lock:
+        stats = dict(_pool_stats)
+        stats['idle'] = sum(len(idle) for idle in _pool_idle.values())
+
+    return stats
+
+
+# container reaper
+
+"""
+Containers handed over to the reaper threads for removal, as (submission slot, container).
+"""
+_reap_queue = Queue()
+_reap_pending = {}
+_reap_cond = threading.Condition()
+_reap_threads = []
+
+
+def _reap_loop():
+    while True:
+        slot, container = _reap_queue.get()
+
+        try:
+            docker_cli.remove_container(container, force=True)
+        except APIError:
+            logging.exception('Failed to remove container {}.'.format(container_id(container)))
+
+        _pool_lent.discard(container_id(container))
+
+        with _reap_cond:
+            _reap_pending[slot] -= 1
+
+            if not _reap_pending[slot]:
+                del _reap_pending[slot]
+
+            _reap_cond.notify_all()
+
+
+def reap_container(container):
+    """
+    Remove the container in the background, so the next test does not have to wait.
+    Everything what is needed from the container (stdout, stats) has to be collected before.
+    """
+    cgroup.forget(container_id(container))
+    slot = get_slot()
+
+    with _reap_cond:
+        _reap_pending[slot] = _reap_pending.get(slot, 0) + 1
+
+        # one thread for each test which may be running at the same time
+        while len(_reap_threads) < SUBMISSION_SLOTS * TEST_SLOTS:
+            thread = threading.Thread(target=_reap_loop, name='container-reaper', daemon=True)
+            thread.start()
+            _reap_threads.append(thread)
+
+    _reap_queue.put((slot, container))
+
+
+def wait_for_reaper(all_slots=False):
+    """
+    Block until the containers handed over to the reaper by the current submission slot,
+    or by any slot if `all_slots` is set, are removed.
+    """
+    slot = get_slot()
+
+    with _reap_cond:
+        _reap_cond.wait_for(lambda: not _reap_pending if all_slots else slot not in _reap_pending)
+
+
 # network
 
 def create_network():
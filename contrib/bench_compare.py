@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from env_provider.comparators import COMPARATORS, compare, read_chunks
+
+
+def legacy_compare(fname1, fname2):
+    """
+    The line-by-line comparison which was used by env_provider/file.py before the comparators.
+    """
+    f1 = open(fname1, 'r')
+    f2 = open(fname2, 'r')
+
+    while True:
+        line1 = f1.readline()
+        line2 = f2.readline()
+
+        if not line1 and line2 or line1 and not line2:
+            return False
+
+        if not line1 and not line2:
+            return True
+
+        if line1.strip() != line2.strip():
+            return False
+
+
+def on_files(comparator):
+    return lambda fname1, fname2: comparator(read_chunks(fname1), read_chunks(fname2))
+
+
+def generate_output(file_name, size, line_length):
+    with open(file_name, 'w') as f:
+        written = 0
+
+        while written < size:
+            line = ' '.join(str(random.randint(0, 10 ** 9)) for _ in range(max(1, line_length // 11))) + '\n'
+            f.write(line)
+            written += len(line)
+
+
+def measure(func, fname1, fname2, repeat):
+    best = None
+
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func(fname1, fname2)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the speed of output comparators.')
+    parser.add_argument('--size', type=int, default=50, help='size of the compared outputs in MB')
+    parser.add_argument('--line-length', type=int, default=80, help='approximate length of lines')
+    parser.add_argument('--repeat', type=int, default=3, help='how many times each comparison is run')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        expected = os.path.join(tmp_dir, 'expected.txt')
+        output = os.path.join(tmp_dir, 'output.txt')
+
+        print('Generating {} MB of output...'.format(args.size))
+        generate_output(expected, args.size * 1024 * 1024, args.line_length)
+
+        # the output differs in the line endings and the trailing whitespace of the last line,
+        # so it is accepted by "whitespace" and "tokens" only after reading all of it
+        with open(expected, 'rb') as src, open(output, 'wb') as dest:
+            dest.write(src.read()[:-1].replace(b'\n', b'\r\n') + b' \r\n')
+
+        comparators = [('legacy', legacy_compare)] + [(name, on_files(func)) for name, func in sorted(COMPARATORS.items())]
+
+        for name, func in comparators:
+            result, elapsed = measure(func, output, expected, args.repeat)
+            print('{:>14}: {:8.3f} s, {:8.1f} MB/s, equal: {}'.format(name, elapsed, args.size / elapsed, result))
+
+        result, elapsed = measure(lambda fname1, fname2: compare('whitespace', fname1, fname2),
+                                  expected, expected, args.repeat)
+        print('{:>14}: {:8.3f} s, {:8.1f} MB/s, equal: {}'.format('identical', elapsed, args.size / elapsed, result))
+
+
+if __name__ == '__main__':
+    main()
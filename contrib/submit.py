@@ -31,6 +31,8 @@ def upload_submission(data, content_dirname, debug=False):
     seq_number = rs.incrby("queue:{}:counter".format(queue_priority), 1)
     rs.zadd("queue:{}:order".format(queue_priority), data['uuid'], seq_number)
     position = rs.rpush("queue:{}".format(queue_priority), json.dumps(data))
+    # wake up an idle worker
+    rs.rpush("queue:wakeup", 1)
 
     if debug:
         print('Submission sequence number: ' + str(seq_number))
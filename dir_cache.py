@@ -0,0 +1,207 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from os.path import join as path_join, getmtime
+from shutil import rmtree
+from uuid import uuid4
+
+
+def directory_size(path):
+    size = 0
+
+    for root, dirs, files in os.walk(path):
+        for file_name in files:
+            try:
+                size += os.lstat(path_join(root, file_name)).st_size
+            except FileNotFoundError:
+                pass
+
+    return size
+
+
+class DirectoryCache:
+    """
+    Cache of directories stored under `root` and identified by keys, which have to be valid
+    file names. When the total size exceeds `max_bytes`, the least recently used entries are
+    evicted. Entries are pinned while being used, pinned entries are never evicted.
+    The cache is shared by all threads of the worker.
+    """
+
+    def __init__(self, name, root, max_bytes):
+        self.name = name
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = None
+        self._pins = {}
+        self._size = 0
+
+    def _load(self):
+        """
+        Build the in-memory index from the cache directory, this is done only once.
+        """
+        if self._entries is not None:
+            return
+
+        self._entries = OrderedDict()
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+
+        for key in os.listdir(self.root):
+            path = path_join(self.root, key)
+
+            if key.startswith('.tmp-'):
+                # leftover of an interrupted store
+                rmtree(path, ignore_errors=True)
+            elif os.path.isdir(path):
+                found.append((getmtime(path), key, directory_size(path)))
+
+        for mtime, key, size in sorted(found):
+            self._entries[key] = size
+            self._size += size
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def path(self, key):
+        return path_join(self.root, key)
+
+    def lookup(self, key):
+        """
+        Find the entry and pin it, so it would not be evicted until `release` is called.
+        :return path of the entry or None if there is no such entry
+        """
+        with self._lock:
+            self._load()
+
+            if key not in self._entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            self._pins[key] = self._pins.get(key, 0) + 1
+
+        # the modification time keeps the LRU order for the next start of the worker
+        os.utime(self.path(key), None)
+        return self.path(key)
+
+    def store(self, key, fill):
+        """
+        Create a new entry by calling `fill` with a path to an empty temporary directory,
+        which is then atomically moved into the cache. The new entry is pinned.
+        :return path of the entry
+        """
+        tmp_path = path_join(self.root, '.tmp-{}'.format(uuid4().hex))
+
+        with self._lock:
+            self._load()
+
+        os.makedirs(tmp_path)
+
+        try:
+            fill(tmp_path)
+            size = directory_size(tmp_path)
+        except BaseException:
+            rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        with self._lock:
+            if key in self._entries:
+                # some other thread was faster
+                rmtree(tmp_path, ignore_errors=True)
+                self._entries.move_to_end(key)
+            else:
+                os.rename(tmp_path, self.path(key))
+                self._entries[key] = size
+                self._size += size
+
+            self._pins[key] = self._pins.get(key, 0) + 1
+            self._evict()
+
+        return self.path(key)
+
+    def extend(self, key, fill):
+        """
+        Call `fill` with the path of the entry to add more files into it, the entry is created
+        by `store` if it does not exist yet. The entry is not left pinned.
+        """
+        with self._lock:
+            self._load()
+            exists = key in self._entries
+
+            if exists:
+                self._pins[key] = self._pins.get(key, 0) + 1
+
+        if not exists:
+            self.store(key, fill)
+            self.release(key)
+            return
+
+        try:
+            fill(self.path(key))
+        finally:
+            self.release(key)
+
+        self.update_size(key)
+
+    def release(self, key):
+        with self._lock:
+            self._pins[key] -= 1
+
+            if not self._pins[key]:
+                del self._pins[key]
+
+            self._evict()
+
+    def discard(self, key):
+        """
+        Release the entry and remove it, unless it is still used by someone else.
+        Used for entries which turned out to be broken.
+        """
+        with self._lock:
+            self._pins[key] -= 1
+
+            if not self._pins[key]:
+                del self._pins[key]
+
+                if key in self._entries:
+                    self._size -= self._entries.pop(key)
+                    rmtree(self.path(key), ignore_errors=True)
+
+    def update_size(self, key):
+        """
+        Recalculate the size of the entry after something was added into it.
+        """
+        size = directory_size(self.path(key))
+
+        with self._lock:
+            if key in self._entries:
+                self._size += size - self._entries[key]
+                self._entries[key] = size
+                self._evict()
+
+    def _evict(self):
+        for key in list(self._entries.keys()):
+            if self._size <= self.max_bytes:
+                break
+
+            if key in self._pins:
+                continue
+
+            logging.info('Evicting {} cache entry: {}'.format(self.name, key))
+            self._size -= self._entries.pop(key)
+            rmtree(self.path(key), ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries or {}),
+                "bytes": self._size
+            }
@@ -1,10 +1,9 @@
-from os import path, listdir, chmod, walk, makedirs
+from os import path, listdir, chmod, walk
 from os.path import splitext
 
-from shutil import rmtree, copytree
 
 from tuples import TestUnit
-from workdir import internal_path
+from workdir import internal_path, clear_directory, copy_directory_content
 
 
 class EnvConfigurationError(RuntimeError):
@@ -64,20 +63,44 @@ def do_create_test_units(submission, env_conf, pack):
     return test_units
 
 
-def copy_data_directory(pack, test_unit):
-    rmtree(internal_path('work/run/data'))
+def slot_location(location, slot):
+    """
+    Location of the runner for the given test slot, the first slot uses the configured one.
+    """
+    if not slot:
+        return location
+
+    return '{}-{}'.format(location, slot)
+
+
+def cleanup_runner(runner, runner_conf):
+    """
+    Let the runner release what it kept for the test, do_cleanup is optional for the runners.
+    """
+    if hasattr(runner, 'do_cleanup'):
+        runner.do_cleanup(runner_conf)
+
+
+def copy_program(location):
+    """
+    Input everything which was outputted from the compilation into the runner's location.
+    """
+    clear_directory(internal_path(path.join(location, 'in')))
+    copy_directory_content(internal_path('work/compile/out'), internal_path(path.join(location, 'in')))
+
+
+def copy_data_directory(pack, test_unit, location='work/run'):
+    data_path = internal_path(path.join(location, 'data'))
+    clear_directory(data_path)
 
     if path.exists(path.join(pack.path, 'data', test_unit.name)):
-        copytree(path.join(pack.path, 'data', test_unit.name), internal_path('work/run/data'))
-    else:
-        makedirs(internal_path('work/run/data'))
+        copy_directory_content(path.join(pack.path, 'data', test_unit.name), data_path)
 
     # give permissions for data directory
-    chmod(internal_path('work/run/data'), 0o777)
+    chmod(data_path, 0o777)
 
-    for root, dirs, files in walk(internal_path('work/run/data')):
+    for root, dirs, files in walk(data_path):
         for entry in dirs:
             chmod(path.join(root, entry), 0o777)
         for entry in files:
             chmod(path.join(root, entry), 0o666)
-
@@ -0,0 +1,363 @@
+import logging
+import os
+import re
+
+import numpy
+
+"""
+Comparators of the program's output with the expected output. Both files are read in chunks
+of CHUNK_SIZE bytes, each comparator turns the chunks into a canonical stream and the streams
+are compared until the first difference, so the memory usage does not depend on the size
+of the outputs or the length of their lines.
+"""
+CHUNK_SIZE = 1024 * 1024
+
+# whitespace other than newlines, as understood by bytes.strip()
+_LINE_WHITESPACE = b' \t\x0b\x0c'
+_AROUND_NEWLINE_RE = re.compile(rb'[ \t\x0b\x0c]*\n[ \t\x0b\x0c]*')
+
+DEFAULT_ABS_TOLERANCE = 1e-6
+DEFAULT_REL_TOLERANCE = 1e-6
+
+
+class UnknownComparator(RuntimeError):
+    def __init__(self, *args, **kwargs):
+        RuntimeError.__init__(self, *args, **kwargs)
+
+
+class Mismatch:
+    """
+    Returned instead of False by the comparators which can tell where the outputs differ.
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'Mismatch({!r})'.format(self.message)
+
+
+def read_chunks(file_name):
+    with open(file_name, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+
+            if not chunk:
+                return
+
+            yield chunk
+
+
+def read_pipe(pipe):
+    """
+    Like read_chunks, but reads an unbuffered pipe and returns every chunk as soon as it is written
+    into the pipe, without waiting until CHUNK_SIZE bytes are available.
+    """
+    while True:
+        chunk = pipe.read(CHUNK_SIZE)
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def normalize_line_endings(chunks):
+    """
+    Turn \\r\\n and \\r into \\n, like Python's universal newlines.
+    """
+    carry = b''
+
+    for chunk in chunks:
+        chunk = carry + chunk
+        carry = b''
+
+        # \r at the end of the chunk may be the first half of \r\n
+        if chunk.endswith(b'\r'):
+            chunk, carry = chunk[:-1], b'\r'
+
+        yield chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+    if carry:
+        yield b'\n'
+
+
+def strip_lines(chunks):
+    """
+    Strip the leading and trailing whitespace of every line and end each line with \\n,
+    so the stream is equal for the outputs accepted by the original line-by-line comparison.
+    """
+    at_line_start = True
+    line_open = False
+    carry = b''
+
+    for chunk in normalize_line_endings(chunks):
+        if not chunk:
+            continue
+
+        line_open = not chunk.endswith(b'\n')
+        chunk = carry + chunk
+
+        if at_line_start:
+            chunk = chunk.lstrip(_LINE_WHITESPACE)
+
+        # whitespace at the end of the chunk is kept until it is known whether the line ends there
+        stripped = chunk.rstrip(_LINE_WHITESPACE)
+        carry = chunk[len(stripped):]
+
+        # usually there is nothing to strip, which is much faster to find out than to run the regex
+        if b' \n' in stripped or b'\n ' in stripped or b'\t' in stripped or b'\x0b' in stripped \
+                or b'\x0c' in stripped:
+            chunk = _AROUND_NEWLINE_RE.sub(b'\n', stripped)
+        else:
+            chunk = stripped
+
+        if chunk:
+            at_line_start = chunk.endswith(b'\n')
+            yield chunk
+
+    # the last line may be ended by the end of the file instead of a newline
+    if line_open:
+        yield b'\n'
+
+
+def split_tokens(chunks):
+    """
+    Split the chunks into lists of whitespace separated tokens, a token is never split between two lists.
+    """
+    carry = b''
+
+    for chunk in chunks:
+        # the last token may continue in the next chunk
+        chunk = carry + chunk
+        tokens = chunk.split()
+        carry = tokens.pop() if tokens and not chunk[-1:].isspace() else b''
+
+        if tokens:
+            yield tokens
+
+    if carry:
+        yield [carry]
+
+
+def join_tokens(chunks):
+    """
+    Replace every run of whitespace, including newlines, by a single space and drop
+    the whitespace at the beginning and at the end.
+    """
+    at_start = True
+
+    for tokens in split_tokens(chunks):
+        if not at_start:
+            yield b' '
+
+        at_start = False
+        yield b' '.join(tokens)
+
+
+def parse_numbers(tokens):
+    """
+    :return array of the values of the tokens, NaN where the token is not a number,
+    and array telling which of the tokens are numbers
+    """
+    try:
+        # float() is faster than the conversion of strings by numpy
+        return numpy.fromiter(map(float, tokens), dtype=numpy.float64, count=len(tokens)), None
+    except ValueError:
+        pass
+
+    # at least one of the tokens is not a number, so they are parsed one by one
+    values = numpy.full(len(tokens), numpy.nan)
+    numeric = numpy.ones(len(tokens), dtype=bool)
+
+    for i, token in enumerate(tokens):
+        try:
+            values[i] = float(token)
+        except ValueError:
+            numeric[i] = False
+
+    return values, numeric
+
+
+def first_numeric_mismatch(tokens1, tokens2, abs_tolerance, rel_tolerance):
+    """
+    Compare two equally long lists of tokens, numbers are equal if they are close enough to each other
+    and the other tokens have to be equal exactly.
+    :return index of the first pair of tokens which are not equal or None
+    """
+    # the numbers are usually written the same way in both outputs
+    if tokens1 == tokens2:
+        return None
+
+    values1, numeric1 = parse_numbers(tokens1)
+    values2, numeric2 = parse_numbers(tokens2)
+
+    with numpy.errstate(invalid='ignore', over='ignore'):
+        equal = numpy.isclose(values1, values2, rtol=rel_tolerance, atol=abs_tolerance, equal_nan=True)
+
+    if numeric1 is not None or numeric2 is not None:
+        numeric1 = numpy.ones(len(tokens1), dtype=bool) if numeric1 is None else numeric1
+        numeric2 = numpy.ones(len(tokens2), dtype=bool) if numeric2 is None else numeric2
+        equal &= numeric1 & numeric2
+
+        # the tokens which are not numbers have to be written the same way
+        for i in numpy.flatnonzero(~numeric1 | ~numeric2):
+            equal[i] = tokens1[i] == tokens2[i]
+
+    mismatches = numpy.flatnonzero(~equal)
+    return int(mismatches[0]) if len(mismatches) else None
+
+
+def streams_equal(stream1, stream2):
+    """
+    Compare two streams of byte chunks, which may be split at different places.
+    """
+    stream1 = iter(stream1)
+    stream2 = iter(stream2)
+    buffer1 = buffer2 = b''
+    pos1 = pos2 = 0
+
+    while True:
+        if pos1 == len(buffer1):
+            buffer1 = next(stream1, None)
+            pos1 = 0
+
+            if buffer1 is None:
+                # the other stream has to end as well, empty chunks do not matter
+                return pos2 == len(buffer2) and not any(stream2)
+
+            continue
+
+        if pos2 == len(buffer2):
+            buffer2 = next(stream2, None)
+            pos2 = 0
+
+            if buffer2 is None:
+                return False
+
+            continue
+
+        length = min(len(buffer1) - pos1, len(buffer2) - pos2)
+
+        if length == len(buffer1) == len(buffer2):
+            # both chunks are compared as a whole, which is the usual case
+            if buffer1 != buffer2:
+                return False
+        elif buffer1[pos1:pos1 + length] != buffer2[pos2:pos2 + length]:
+            return False
+
+        pos1 += length
+        pos2 += length
+
+
+def compare_exact(chunks1, chunks2, options=None):
+    return streams_equal(chunks1, chunks2)
+
+
+def compare_line_endings(chunks1, chunks2, options=None):
+    return streams_equal(normalize_line_endings(chunks1), normalize_line_endings(chunks2))
+
+
+def compare_whitespace(chunks1, chunks2, options=None):
+    return streams_equal(strip_lines(chunks1), strip_lines(chunks2))
+
+
+def compare_tokens(chunks1, chunks2, options=None):
+    return streams_equal(join_tokens(chunks1), join_tokens(chunks2))
+
+
+def compare_numeric(chunks1, chunks2, options=None):
+    """
+    Compare whitespace separated tokens, the numbers are equal if
+    |number1 - number2| <= abs_tolerance + rel_tolerance * |number2|,
+    so the expected output should be the second stream.
+    :return True or Mismatch telling the position of the first different token
+    """
+    options = options or {}
+    abs_tolerance = float(options.get('abs_tolerance', DEFAULT_ABS_TOLERANCE))
+    rel_tolerance = float(options.get('rel_tolerance', DEFAULT_REL_TOLERANCE))
+
+    stream1 = split_tokens(chunks1)
+    stream2 = split_tokens(chunks2)
+    tokens1 = tokens2 = []
+    position = 0
+
+    while True:
+        if not tokens1:
+            tokens1 = next(stream1, None)
+
+        if not tokens2:
+            tokens2 = next(stream2, None)
+
+        if tokens1 is None or tokens2 is None:
+            if tokens1 is None and tokens2 is None:
+                return True
+
+            mismatch = Mismatch('The output has {} tokens than expected, the first {} tokens are equal'
+                                .format('more' if tokens2 is None else 'fewer', position))
+            logging.info(mismatch.message)
+            return mismatch
+
+        length = min(len(tokens1), len(tokens2))
+        mismatch = first_numeric_mismatch(tokens1[:length], tokens2[:length], abs_tolerance, rel_tolerance)
+
+        if mismatch is not None:
+            mismatch = Mismatch('The output differs from the expected one at token {}: "{}" instead of "{}"'.format(
+                position + mismatch, tokens1[mismatch].decode(errors='replace')[:64],
+                tokens2[mismatch].decode(errors='replace')[:64]))
+            logging.info(mismatch.message)
+            return mismatch
+
+        position += length
+        tokens1 = tokens1[length:]
+        tokens2 = tokens2[length:]
+
+
+"""
+Available comparators, by the name used in the configuration:
+exact - files have to be equal byte by byte
+line_endings - \\r\\n, \\r and \\n newlines are taken to be equal
+whitespace - lines are compared without their leading and trailing whitespace (the default)
+tokens - whitespace separated tokens are compared, the layout of lines does not matter
+numeric - like tokens, but numbers only have to be equal within abs_tolerance and rel_tolerance
+"""
+COMPARATORS = {
+    "exact": compare_exact,
+    "line_endings": compare_line_endings,
+    "whitespace": compare_whitespace,
+    "tokens": compare_tokens,
+    "numeric": compare_numeric
+}
+
+
+def get_comparator(mode):
+    try:
+        return COMPARATORS[mode]
+    except KeyError:
+        raise UnknownComparator('Unknown comparator: "{}", available are: {}'
+                                .format(mode, ', '.join(sorted(COMPARATORS.keys()))))
+
+
+def compare(mode, file_name1, file_name2, options=None):
+    comparator = get_comparator(mode)
+
+    # equal files are equal for every comparator, which is the usual case and the fastest one to check
+    if os.path.getsize(file_name1) == os.path.getsize(file_name2) \
+            and streams_equal(read_chunks(file_name1), read_chunks(file_name2)):
+        return True
+
+    if comparator is compare_exact:
+        return False
+
+    return comparator(read_chunks(file_name1), read_chunks(file_name2), options)
+
+
+def compare_stream(mode, chunks, file_name, options=None):
+    """
+    Compare the output which is still being produced with the expected output in the file `file_name`.
+    The comparison stops at the first difference, without waiting for the rest of the output.
+    """
+    return get_comparator(mode)(chunks, read_chunks(file_name), options)
@@ -1,75 +1,163 @@
 import logging
-from filecmp import cmp
-from os import chmod, path, walk
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import path, mkfifo, chmod
 
-from shutil import rmtree, copytree, copy
+from shutil import copy
 
 import plugin_loader
 import task_queue
 from tuples import TestStatus
-from workdir import internal_path
+from workdir import internal_path, get_slot, set_slot
 import env_provider.common as common
+from env_provider.comparators import compare, compare_stream, get_comparator, read_pipe
+from runners.common import max_output_bytes
 
 
 def do_create_test_units(submission, env_conf, pack):
     return common.do_create_test_units(submission, env_conf, pack)
 
 
-def copy_data_directory(pack, test_unit):
-    if path.exists(path.join(pack.path, 'data', test_unit.name)):
-        rmtree(internal_path('work/run/data'))
-        copytree(path.join(pack.path, 'data', test_unit.name), internal_path('work/run/data'))
+def comparator_mode(env_conf, evaluator_conf, test_unit):
+    """
+    The comparator may be chosen for the whole package or overridden by the options of a test,
+    "binary_mode" of the evaluator makes the outputs to be compared exactly.
+    """
+    try:
+        return test_unit.runner_meta['options']['comparator']
+    except KeyError:
+        pass
+
+    if evaluator_conf.get('binary_mode'):
+        return 'exact'
+
+    return env_conf['comparator']
+
+
+def comparator_options(env_conf, test_unit):
+    """
+    Options of the comparator, like the tolerances of the numeric one, may be overridden by the options of a test.
+    """
+    options = dict(env_conf)
+    options.update(test_unit.runner_meta['options'])
+    return options
+
+
+def open_output_pipe(output_path):
+    """
+    Create a FIFO in place of the output file and open both of its ends. The write end is kept only
+    so that reading blocks until the program opens the FIFO, the output ends after it is closed.
+    :return the read end as an unbuffered file and the descriptor of the write end
+    """
+    mkfifo(output_path)
+    chmod(output_path, 0o666)
+
+    read_fd = os.open(output_path, os.O_RDONLY | os.O_NONBLOCK)
+    write_fd = os.open(output_path, os.O_WRONLY)
+    os.set_blocking(read_fd, True)
+
+    return open(read_fd, 'rb', buffering=0), write_fd
+
 
-    # give permissions for data directory
-    chmod(internal_path('work/run/data'), 0o777)
+def limit_output(chunks, max_bytes, exceeded):
+    """
+    Pass the chunks through until there are more than `max_bytes` bytes, then set `exceeded` and stop.
+    """
+    total_bytes = 0
 
-    for root, dirs, files in walk(internal_path('work/run/data')):
-        for entry in dirs:
-            chmod(path.join(root, entry), 0o777)
-        for entry in files:
-            chmod(path.join(root, entry), 0o666)
+    for chunk in chunks:
+        total_bytes += len(chunk)
 
+        if total_bytes > max_bytes:
+            exceeded.set()
+            return
 
-def compare(fname1, fname2, binary_mode=False):
-    if binary_mode:
-        return cmp(fname1, fname2, shallow=False)
+        yield chunk
 
-    f1 = open(fname1, 'r')
-    f2 = open(fname2, 'r')
 
-    while True:
-        line1 = f1.readline()
-        line2 = f2.readline()
+def run_judged_live(runner, runner_conf, output_path, expected_path, mode, options):
+    """
+    Run the test while its output is compared with the expected one, the test is aborted
+    as soon as the output is known to be wrong or too large.
+    :return result of the runner and result of the comparison
+    """
+    get_comparator(mode)
+    output_pipe, pipe_keeper = open_output_pipe(output_path)
+    test_done = threading.Event()
+    limit_exceeded = threading.Event()
+    # the runner limits only regular files, the FIFO has to be limited here
+    output_limit = max_output_bytes(runner_conf)
+    submission_slot = get_slot()
 
-        # if one of files had already ended then for sure it's not equal
-        if not line1 and line2 or line1 and not line2:
-            return False
+    def judge():
+        # the judge thread works within the workdir of the submission slot
+        set_slot(submission_slot)
 
-        # if both files ended at the same time then these are equal
-        if not line1 and not line2:
-            return True
+        try:
+            chunks = read_pipe(output_pipe)
 
-        # if given line doesn't match then files are not equal
-        if line1.strip() != line2.strip():
-            return False
+            if output_limit:
+                chunks = limit_output(chunks, output_limit, limit_exceeded)
 
+            equal = compare_stream(mode, chunks, expected_path, options) and not limit_exceeded.is_set()
 
-def do_run_test(submission, env_conf, pack, test_unit):
+            # the test has to be aborted before the pipe is closed, otherwise the program could die
+            # of SIGPIPE first and the wrong answer would be reported as a bad exit code
+            if not equal and not test_done.is_set():
+                logging.info('The output is wrong already, aborting the test')
+                runner.do_abort(runner_conf)
+        finally:
+            output_pipe.close()
+
+        return equal
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        judged = executor.submit(judge)
+
+        try:
+            prog_container = runner.do_run(runner_conf)
+            exc_res = runner.do_wait(runner_conf, prog_container)
+        finally:
+            # the program is not running anymore, so the judge gets to the end of the output
+            test_done.set()
+            os.close(pipe_keeper)
+
+        cmp_res = judged.result()
+
+    if limit_exceeded.is_set():
+        exc_res = exc_res._replace(status='output_limit_exceeded')
+
+    return exc_res, cmp_res
+
+
+def do_run_test(submission, env_conf, pack, test_unit, slot=0):
     runner, runner_conf = plugin_loader.get('runners', pack.config['runner']['name'], pack.config['runner'])
+    runner_conf['location'] = common.slot_location(runner_conf['location'], slot)
 
     runner.do_prepare(runner_conf)
-    # input everything which was outputted from the compilation
-    rmtree(internal_path('work/run/in'))
-    copytree(internal_path('work/compile/out'), internal_path(path.join('work/run/in')))
+    location = runner_conf['location']
 
-    copy_data_directory(pack, test_unit)
+    common.copy_program(location)
+    common.copy_data_directory(pack, test_unit, location)
 
     # upload input file for the test for the runner
-    copy(test_unit.runner_meta['input_file'], internal_path('work/run/in/input.txt'))
+    copy(test_unit.runner_meta['input_file'], internal_path(path.join(location, 'in/input.txt')))
+
+    output_path = internal_path(path.join(location, 'out/output.txt'))
+    evaluator, evaluator_conf = plugin_loader.get('evaluators', pack.config['evaluator']['name'],
+                                                  pack.config['evaluator'])
+    mode = comparator_mode(env_conf, evaluator_conf, test_unit)
+    options = comparator_options(env_conf, test_unit)
 
-    prog_container = runner.do_run(runner_conf)
-    exc_res = runner.do_wait(runner_conf, prog_container)
-    cmp_res = compare(internal_path('work/run/out/output.txt'), test_unit.runner_meta['output_file'])
+    if env_conf['live_judge'] and hasattr(runner, 'do_abort'):
+        exc_res, cmp_res = run_judged_live(runner, runner_conf, output_path, test_unit.runner_meta['output_file'],
+                                           mode, options)
+    else:
+        prog_container = runner.do_run(runner_conf)
+        exc_res = runner.do_wait(runner_conf, prog_container)
+        cmp_res = compare(mode, output_path, test_unit.runner_meta['output_file'], options)
+    common.cleanup_runner(runner, runner_conf)
 
     try:
         if test_unit.runner_meta['options']['store_output'] != 'none':
@@ -86,7 +174,10 @@ def do_run_test(submission, env_conf, pack, test_unit):
     except KeyError:
         max_points = 1.0
 
-    if exc_res.status != 'ok':
+    if exc_res.status == 'aborted':
+        # the test was stopped because of its wrong output
+        status = 'bad_answer'
+    elif exc_res.status != 'ok':
         status = exc_res.status
     elif not cmp_res:
         status = 'bad_answer'
@@ -94,7 +185,11 @@ def do_run_test(submission, env_conf, pack, test_unit):
         status = 'ok'
         points = max_points
 
+    # some comparators tell where the output is wrong
+    message = getattr(cmp_res, 'message', None) if status == 'bad_answer' else None
+
     return TestStatus(name=test_unit.name, status=status, time=exc_res.exec_time,
-                      timeout=exc_res.timeout, memory=exc_res.memory, points=points, max_points=max_points)
+                      timeout=exc_res.timeout, memory=exc_res.memory, points=points, max_points=max_points,
+                      wall_time=exc_res.wall_time, cpu_time=exc_res.cpu_time, message=message)
 
 __plugin__ = {}
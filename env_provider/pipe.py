@@ -1,15 +1,15 @@
 import json
 import logging
 import os
-from os import chmod, path, walk, mkfifo
+from os import chmod, path, mkfifo
 
-from shutil import rmtree, copytree, copy
+from shutil import copy
 
 import plugin_loader
 import task_queue
 from container import file_spinlock
 from tuples import TestStatus
-from workdir import internal_path
+from workdir import internal_path, clear_directory, copy_directory_content
 import env_provider.common as common
 
 
@@ -17,44 +17,46 @@ def do_create_test_units(submission, env_conf, pack):
     return common.do_create_test_units(submission, env_conf, pack)
 
 
-def do_run_test(submission, env_conf, pack, test_unit):
+def do_run_test(submission, env_conf, pack, test_unit, slot=0):
     runner, runner_conf = plugin_loader.get('runners', pack.config['runner']['name'], pack.config['runner'])
-    runner_conf['location'] = 'work/run'
+    runner_conf['location'] = common.slot_location('work/run', slot)
 
     # configure locations of the runners
     srv_runner, srv_runner_conf = plugin_loader.get(
         'runners', pack.config['service_runner']['name'], pack.config['service_runner'])
-    srv_runner_conf['location'] = 'work/srv'
+    srv_runner_conf['location'] = common.slot_location('work/srv', slot)
+    srv_location = srv_runner_conf['location']
+    # service container needs binds to the program's pipes, so it has to be created on demand
+    srv_runner_conf['pool'] = False
 
     srv_runner.do_prepare(srv_runner_conf)
 
     runner.do_prepare(runner_conf)
-    # input everything which was outputted from the compilation
-    rmtree(internal_path('work/run/in'), ignore_errors=True)
-    copytree(internal_path('work/compile/out'), internal_path(path.join('work/run/in')))
+    location = runner_conf['location']
 
-    common.copy_data_directory(pack, test_unit)
+    common.copy_program(location)
+    common.copy_data_directory(pack, test_unit, location)
 
     # upload service program
-    rmtree(internal_path('work/srv/in'), ignore_errors=True)
-    copytree(path.join(pack.path, 'service'), internal_path(path.join('work/srv/in')))
-    chmod(internal_path('work/srv/in/prog'), 0o777)
+    clear_directory(internal_path(path.join(srv_location, 'in')))
+    copy_directory_content(path.join(pack.path, 'service'), internal_path(path.join(srv_location, 'in')))
+    chmod(internal_path(path.join(srv_location, 'in/prog')), 0o777)
 
     # upload input file for the test for service
-    copy(test_unit.runner_meta['input_file'], internal_path('work/srv/in/input.txt'))
+    copy(test_unit.runner_meta['input_file'], internal_path(path.join(srv_location, 'in/input.txt')))
 
     # create pipes which will be used for communication
-    mkfifo(internal_path('work/run/in/input.txt'))
-    mkfifo(internal_path('work/run/out/output.txt'))
-    chmod(internal_path('work/run/in/input.txt'), 0o777)
-    chmod(internal_path('work/run/out/output.txt'), 0o777)
+    mkfifo(internal_path(path.join(location, 'in/input.txt')))
+    mkfifo(internal_path(path.join(location, 'out/output.txt')))
+    chmod(internal_path(path.join(location, 'in/input.txt')), 0o777)
+    chmod(internal_path(path.join(location, 'out/output.txt')), 0o777)
 
     srv_container = srv_runner.do_run(srv_runner_conf, additional_binds={
-        internal_path(os.path.join("work/run/in")): {
+        internal_path(os.path.join(location, "in")): {
             "bind": "/mnt/prog-in",
             "mode": "rw"
         },
-        internal_path(os.path.join("work/run/out")): {
+        internal_path(os.path.join(location, "out")): {
             "bind": "/mnt/prog-out",
             "mode": "rw"
         },
@@ -63,7 +65,7 @@ def do_run_test(submission, env_conf, pack, test_unit):
     exc_container = runner.do_run(runner_conf)
 
     # wait till server is ready
-    if not file_spinlock(internal_path('work/srv/out/srv-ready'), 1.0):
+    if not file_spinlock(internal_path(path.join(srv_location, 'out/srv-ready')), 1.0):
         raise RuntimeError('Service didn\'t started within 1 second.')
 
     # run user's program
@@ -73,10 +75,12 @@ def do_run_test(submission, env_conf, pack, test_unit):
     if exc_res.status in ['soft_timeout', 'hard_timeout']:
         # TODO maybe some better solution?
         srv_runner.do_wait(srv_runner_conf, srv_container, max_time=0.0)
+        common.cleanup_runner(runner, runner_conf)
         return TestStatus(name=test_unit.name, status='hard_timeout', time=exc_res.exec_time, timeout=exc_res.timeout,
                           points=0, max_points=1)
 
     svc_res = srv_runner.do_wait(srv_runner_conf, srv_container, max_time=1.0)
+    common.cleanup_runner(runner, runner_conf)
 
     if svc_res.status == 'bad_exit_code':
         # something went wrong with the service, internal error
@@ -85,7 +89,7 @@ def do_run_test(submission, env_conf, pack, test_unit):
         return TestStatus(name=test_unit.name, status='hard_timeout', time=svc_res.exec_time, timeout=svc_res.timeout,
                           points=0, max_points=1)
 
-    with open(internal_path('work/srv/out/output.txt'), 'r', encoding='utf-8') as output_file:
+    with open(internal_path(path.join(srv_location, 'out/output.txt')), 'r', encoding='utf-8') as output_file:
         out_data = json.loads(output_file.read())
 
     try:
@@ -105,6 +109,7 @@ def do_run_test(submission, env_conf, pack, test_unit):
     max_points = out_data['max_points']
 
     return TestStatus(name=test_unit.name, status=status, time=exc_res.exec_time,
-                      timeout=exc_res.timeout, memory=exc_res.memory, points=points, max_points=max_points)
+                      timeout=exc_res.timeout, memory=exc_res.memory, points=points, max_points=max_points,
+                      wall_time=exc_res.wall_time, cpu_time=exc_res.cpu_time)
 
 __plugin__ = {}
@@ -0,0 +1,94 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+from os.path import exists as path_exists, dirname
+from time import time
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+"""
+Events are only a hint, existence of the file is checked again at least this often (in seconds),
+in case an event gets lost, e.g. on file systems shared with a virtual machine.
+"""
+RECHECK_INTERVAL = 0.25
+
+_libc = None
+
+
+class WatchNotAvailable(RuntimeError):
+    def __init__(self, *args, **kwargs):
+        RuntimeError.__init__(self, *args, **kwargs)
+
+
+def _get_libc():
+    global _libc
+
+    if _libc is None:
+        lib_name = ctypes.util.find_library('c')
+
+        if not lib_name:
+            raise WatchNotAvailable('C library was not found')
+
+        libc = ctypes.CDLL(lib_name, use_errno=True)
+
+        if not hasattr(libc, 'inotify_init1'):
+            raise WatchNotAvailable('inotify is not supported by the system')
+
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc = libc
+
+    return _libc
+
+
+def wait_for_file(file_name, timeout):
+    """
+    Wait until file with name `file_name` is created, using inotify on its directory.
+    :return True if the file exists; False if timeout occurred
+    :raise WatchNotAvailable if the directory can not be watched
+    """
+    libc = _get_libc()
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+    if fd < 0:
+        raise WatchNotAvailable('inotify_init1 failed: {}'.format(os.strerror(ctypes.get_errno())))
+
+    try:
+        mask = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ATTRIB
+
+        if libc.inotify_add_watch(fd, os.fsencode(dirname(file_name)), mask) < 0:
+            raise WatchNotAvailable('inotify_add_watch failed: {}'.format(os.strerror(ctypes.get_errno())))
+
+        # the file may have been created before the watch was added
+        deadline = time() + timeout
+
+        while not path_exists(file_name):
+            remaining = deadline - time()
+
+            if remaining <= 0:
+                return False
+
+            readable, _, _ = select.select([fd], [], [], min(remaining, RECHECK_INTERVAL))
+
+            if readable:
+                _drain(fd)
+
+        return True
+    finally:
+        os.close(fd)
+
+
+def _drain(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError as e:
+        if e.errno != errno.EAGAIN:
+            logging.warning('Failed to read inotify events: {}'.format(e))
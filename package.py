@@ -1,19 +1,62 @@
+import hashlib
 import json
 import logging
 import os
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 from zipfile import ZipFile, BadZipfile
 
-from os.path import join as path_join, getmtime
+from os.path import join as path_join
 
 import collections
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
+import package_store
 import task_queue
+from dir_cache import DirectoryCache
 from tuples import Package
 from workdir import internal_path
+from worker_conf import PACKAGE_CACHE_MAX_BYTES, PACKAGE_REVALIDATE_SECONDS, SUBMISSION_SLOTS
+
+
+"""
+Downloaded packages, shared by all submission slots. Each entry contains the package itself
+in the "package" directory and the files built from it in the "build" directory. With the shared
+package store, the files of the package are hard links into the store.
+"""
+package_cache = DirectoryCache('package', internal_path('package_cache'), PACKAGE_CACHE_MAX_BYTES)
+
+"""
+Locks of the packages which are being looked up, so the same package is downloaded only once.
+"""
+_package_locks = {}
+_package_locks_lock = threading.Lock()
+
+
+"""
+Name of the file, stored in the package downloaded from a URL, with its validators and hash.
+"""
+DOWNLOAD_INFO_NAME = '.download.json'
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+"""
+How many threads extract a downloaded package.
+"""
+EXTRACT_THREADS = min(4, os.cpu_count() or 1)
+
+_session = None
+_session_lock = threading.Lock()
+
+"""
+When the packages downloaded from URLs were last revalidated, by their file name.
+"""
+_revalidated = {}
 
 
 class PackageLoadError(RuntimeError):
@@ -22,64 +65,319 @@ class PackageLoadError(RuntimeError):
 
 
 def prune_unused_packages():
+    """
+    Remove packages stored by the older versions of the worker, which were not limited in size.
+    """
     packages_dir = internal_path('packages')
 
-    # if package cache doesn't exist yet then we don't care
-    if not os.path.isdir(packages_dir):
-        return
+    if os.path.isdir(packages_dir):
+        logging.info('Removing packages stored outside of the package cache')
+        shutil.rmtree(packages_dir)
 
-    for dir in os.listdir(packages_dir):
-        path = path_join(packages_dir, dir)
 
-        if getmtime(path) + 60*60 < time():
-            logging.info('Removing unused package: {}'.format(dir))
-            shutil.rmtree(path)
+def package_session():
+    """
+    HTTP session shared by all downloads, so the connections to the package servers are reused.
+    """
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(pool_maxsize=SUBMISSION_SLOTS,
+                                  max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504]))
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+
+        return _session
+
+
+def extract_members(zip_path, members, dest):
+    with ZipFile(zip_path, 'r') as z:
+        for member in members:
+            try:
+                z.extract(member, dest)
+            except FileExistsError:
+                # another thread has just created the same directory
+                z.extract(member, dest)
+
+
+def extract_package(zip_path, dest):
+    """
+    Extract the zip file, the members are decompressed by several threads at once.
+    """
+    try:
+        with ZipFile(zip_path, 'r') as z:
+            members = z.infolist()
+
+            if EXTRACT_THREADS == 1 or len(members) == 1:
+                z.extractall(dest)
+                return
+
+        os.makedirs(dest, exist_ok=True)
+        # large members are spread over the threads first
+        members.sort(key=lambda member: member.file_size, reverse=True)
+        groups = [members[i::EXTRACT_THREADS] for i in range(EXTRACT_THREADS)]
+
+        with ThreadPoolExecutor(max_workers=EXTRACT_THREADS) as executor:
+            for future in [executor.submit(extract_members, zip_path, group, dest) for group in groups if group]:
+                future.result()
+    except BadZipfile as e:
+        raise PackageLoadError('Malformed package zip file') from e
 
 
-def download_package_from_url(url, dest):
+def download_package_from_url(url, dest, sha256=None, size=None):
+    """
+    Download the zip file of the package and extract it into `dest`. The size and the hash
+    of the file are checked against the expected ones, if they are known.
+    """
     logging.info('Attempting to download missing package from: ' + url)
     tmp_path = internal_path("work/dl_package.zip")
+    hasher = hashlib.sha256()
+    downloaded_size = 0
 
     try:
-        req = requests.get(url, stream=True, timeout=10)
+        req = package_session().get(url, stream=True, timeout=10)
+
+        try:
+            if req.status_code != 200:
+                raise PackageLoadError('Package download failed, server said: {} {}'
+                                       .format(req.status_code, req.reason))
 
-        if req.status_code == 200:
             with open(tmp_path, 'wb') as tmp_file:
-                req.raw.decode_content = True
-                shutil.copyfileobj(req.raw, tmp_file)
-        else:
-            raise PackageLoadError('Package download failed, server said: {} {}'.format(req.status_code, req.reason))
+                for chunk in req.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    hasher.update(chunk)
+                    tmp_file.write(chunk)
+                    downloaded_size += len(chunk)
+
+            # the length of encoded content does not tell anything about the decoded one
+            content_length = req.headers.get('Content-Length') if 'Content-Encoding' not in req.headers else None
+            download_info = {
+                "url": url,
+                "etag": req.headers.get('ETag'),
+                "last_modified": req.headers.get('Last-Modified'),
+                "sha256": hasher.hexdigest(),
+                "size": downloaded_size
+            }
+        finally:
+            req.close()
+    except PackageLoadError:
+        raise
     except (RuntimeError, IOError) as e:
         raise PackageLoadError('Package download failed due to an error') from e
 
+    if content_length is not None and int(content_length) != downloaded_size:
+        raise PackageLoadError('Package download was incomplete, got {} of {} bytes'
+                               .format(downloaded_size, content_length))
+
+    if size is not None and int(size) != downloaded_size:
+        raise PackageLoadError('Package has {} bytes, expected {}'.format(downloaded_size, size))
+
+    if sha256 is not None and sha256.lower() != download_info['sha256']:
+        raise PackageLoadError('Package has SHA-256 {}, expected {}'.format(download_info['sha256'], sha256))
+
     logging.info('Extracting package...')
+    extract_package(tmp_path, dest)
+    os.remove(tmp_path)
+
+    with open(path_join(dest, DOWNLOAD_INFO_NAME), 'w') as info_file:
+        json.dump(download_info, info_file)
+
+
+def download_matches(package_path, sha256=None, size=None):
+    """
+    Check the cached package against the expected hash and size of its zip file, as recorded
+    when the package was downloaded from a URL.
+    :return False if the package is known to be a different one
+    """
+    if sha256 is None and size is None:
+        return True
+
     try:
-        with ZipFile(tmp_path, "r") as z:
-            z.extractall(dest)
-    except BadZipfile as e:
-        raise PackageLoadError('Malformed package zip file') from e
+        with open(path_join(package_path, DOWNLOAD_INFO_NAME), 'r') as info_file:
+            download_info = json.load(info_file)
+    except (IOError, ValueError):
+        # the package was not downloaded from a URL
+        return True
 
-    os.remove(tmp_path)
+    if size is not None and int(size) != download_info.get('size'):
+        return False
 
+    return sha256 is None or sha256.lower() == download_info.get('sha256')
 
-def get_package(name, version, url=None):
+
+def revalidate_package(file_name, package_path, url):
     """
-    Fetch package with matching name and version.
-    If it is not possible, package will be fetched from given url.
+    Ask the server whether the cached package is still the one which it serves at `url`,
+    at most once per PACKAGE_REVALIDATE_SECONDS.
+    :return False if the package has changed
+    """
+    checked = _revalidated.get(file_name)
+
+    if not PACKAGE_REVALIDATE_SECONDS or checked is not None and checked + PACKAGE_REVALIDATE_SECONDS > time():
+        return True
+
+    try:
+        with open(path_join(package_path, DOWNLOAD_INFO_NAME), 'r') as info_file:
+            download_info = json.load(info_file)
+    except (IOError, ValueError):
+        # the package was not downloaded from a URL
+        return True
+
+    headers = {}
+
+    if download_info.get('etag'):
+        headers['If-None-Match'] = download_info['etag']
+
+    if download_info.get('last_modified'):
+        headers['If-Modified-Since'] = download_info['last_modified']
+
+    if download_info.get('url') != url or not headers:
+        return True
+
+    try:
+        req = package_session().get(url, headers=headers, stream=True, timeout=10)
+        req.close()
+    except IOError:
+        logging.warning('Failed to revalidate package {}, using the cached one'.format(file_name), exc_info=True)
+        return True
+
+    if req.status_code == 304:
+        _revalidated[file_name] = time()
+        return True
+
+    if req.status_code == 200:
+        return False
+
+    logging.warning('Failed to revalidate package {}, server said: {} {}'
+                    .format(file_name, req.status_code, req.reason))
+    return True
+
+
+def package_lock(file_name):
+    with _package_locks_lock:
+        return _package_locks.setdefault(file_name, threading.Lock())
+
+
+def fetch_package(name, version, url, dest, sha256=None, size=None):
+    if url:
+        download_package_from_url(url, dest, sha256, size)
+    else:
+        task_queue.download_package(name, version, dest)
+
+
+def fill_cache_entry(file_name, name, version, url, entry_path, sha256=None, size=None):
+    """
+    Put the package into the cache entry, through the shared store of the host if it is enabled.
+    """
+    if package_store.enabled():
+        package_store.link_package(file_name, entry_path,
+                                   lambda dest: fetch_package(name, version, url, dest, sha256, size))
+    else:
+        fetch_package(name, version, url, path_join(entry_path, 'package'), sha256, size)
+
+
+def refresh_package(file_name, entry_path):
+    """
+    Drop the cached package which has changed on the server.
+    :return path of the entry, if it could not be dropped because it is still in use
+    """
+    logging.warning('Package {} has changed on the server without a new version, it will be downloaded again'
+                    .format(file_name))
+    package_cache.discard(file_name)
+
+    if package_store.enabled() and not package_store.invalidate(file_name):
+        logging.warning('Package {} is still used by other instances, they may keep the old one'.format(file_name))
+
+    entry_path = package_cache.lookup(file_name)
+
+    if entry_path:
+        logging.warning('Package {} is still used by other submissions, using the old one'.format(file_name))
+        # the old one is not asked about again with every submission while it is in use
+        _revalidated[file_name] = time()
+
+    return entry_path
+
+
+def drop_mismatched_package(file_name, entry_path):
+    """
+    Drop the cached package which does not have the expected hash or size, it must not be used
+    even if other submissions are still using it.
     """
-    prune_unused_packages()
+    if refresh_package(file_name, entry_path):
+        package_cache.release(file_name)
+        raise PackageLoadError('Package {} does not have the expected hash or size and it can not be '
+                               'downloaded again, because the cached one is still in use'.format(file_name))
 
+
+def store_package(file_name, name, version, url=None, sha256=None, size=None):
+    """
+    Download the package into a new cache entry. The shared store may already have the package
+    from another download, so the entry is checked against the expected hash and size as well.
+    :return path of the entry
+    """
+    def fill(tmp_path):
+        fill_cache_entry(file_name, name, version, url, tmp_path, sha256, size)
+
+    # the package is downloaded into a temporary directory, which is renamed when it is complete
+    entry_path = package_cache.store(file_name, fill)
+    _revalidated[file_name] = time()
+
+    if download_matches(path_join(entry_path, 'package'), sha256, size):
+        return entry_path
+
+    drop_mismatched_package(file_name, entry_path)
+    entry_path = package_cache.store(file_name, fill)
+
+    if not download_matches(path_join(entry_path, 'package'), sha256, size):
+        package_cache.discard(file_name)
+        raise PackageLoadError('Package {} in the shared store does not have the expected hash or size, '
+                               'but it is still used by other instances'.format(file_name))
+
+    return entry_path
+
+
+def get_package(name, version, url=None, sha256=None, size=None):
+    """
+    Fetch package with matching name and version.
+    If it is not possible, package will be fetched from given url,
+    `sha256` and `size` of the downloaded zip file are checked if given.
+    The package is kept in the cache until `release_package` is called.
+    """
     file_name = name + "-v" + str(version)
-    path = internal_path(os.path.join('packages', file_name))
 
-    if not os.path.isdir(path):
-        if url:
-            download_package_from_url(url, path)
+    with package_lock(file_name):
+        entry_path = package_cache.lookup(file_name)
+
+        if entry_path and not download_matches(path_join(entry_path, 'package'), sha256, size):
+            drop_mismatched_package(file_name, entry_path)
+            entry_path = None
+        elif entry_path and url and not revalidate_package(file_name, path_join(entry_path, 'package'), url):
+            entry_path = refresh_package(file_name, entry_path)
+
+        if entry_path:
+            logging.info('Package was taken from the cache ({hits} hits, {misses} misses).'
+                         .format(**package_cache.stats()))
         else:
-            task_queue.download_package(name, version, path)
-    else:
-        os.utime(path, None)
+            entry_path = store_package(file_name, name, version, url, sha256, size)
+
+    try:
+        return load_package(file_name, path_join(entry_path, 'package'))
+    except BaseException:
+        # the package would not be any better the next time
+        package_cache.discard(file_name)
+        raise
 
+
+def release_package(pack):
+    """
+    Let the package be evicted from the cache, after accounting the files built from it.
+    """
+    package_cache.update_size(pack.file_name)
+    package_cache.release(pack.file_name)
+
+
+def load_package(file_name, path):
     yml_file = os.path.join(path, 'config.yml')
     json_file = os.path.join(path, 'config.json')
 
@@ -108,6 +406,14 @@ def get_package(name, version, url=None):
     return Package(file_name, path, raw_config=config, config=None)
 
 
+def package_build_path(pack, *paths):
+    """
+    Path inside the directory with files built from the package, e.g. by the compilers.
+    It is a part of the package's cache entry, so it is evicted together with the package.
+    """
+    return os.path.join(os.path.dirname(pack.path), 'build', *paths)
+
+
 def deep_update(source, overrides):
     # from http://stackoverflow.com/a/30655448
 
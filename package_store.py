@@ -0,0 +1,220 @@
+import errno
+import fcntl
+import logging
+import os
+import stat
+from os.path import join as path_join, isdir, getmtime
+from shutil import rmtree, copy2
+from time import time
+from uuid import uuid4
+
+from dir_cache import directory_size
+from worker_conf import SHARED_PACKAGE_STORE, SHARED_PACKAGE_STORE_MAX_BYTES
+
+"""
+Packages shared by all worker instances running on the host. Each package is downloaded
+into the store only once and the instances get read-only hard links to its files.
+
+Layout of the store:
+<name>         - files of the package
+.locks/<name>  - flock()-ed by the instance which downloads, links or evicts the package
+.refs/<name>   - hard linked into the package cache entry of every instance which uses the package,
+                 so its link count tells how many instances still hold the package
+.tmp-<uuid>    - packages being downloaded
+"""
+
+"""
+Downloads older than this (in seconds) were abandoned by crashed instances.
+"""
+ABANDONED_DOWNLOAD_AGE = 24 * 60 * 60
+
+_cross_device_warned = False
+
+
+def enabled():
+    return bool(SHARED_PACKAGE_STORE)
+
+
+def _lock(file_name, operation):
+    """
+    :return descriptor of the locked lock file of the package
+    """
+    os.makedirs(path_join(SHARED_PACKAGE_STORE, '.locks'), exist_ok=True)
+    fd = os.open(path_join(SHARED_PACKAGE_STORE, '.locks', file_name), os.O_RDWR | os.O_CREAT, 0o666)
+
+    try:
+        fcntl.flock(fd, operation)
+    except BaseException:
+        os.close(fd)
+        raise
+
+    return fd
+
+
+def _unlock(fd):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+def _ref_path(file_name):
+    return path_join(SHARED_PACKAGE_STORE, '.refs', file_name)
+
+
+def _link(src, dest):
+    global _cross_device_warned
+
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+        if not _cross_device_warned:
+            _cross_device_warned = True
+            logging.warning('The shared package store is on another file system than the worker, '
+                            'packages will be copied instead of linked.')
+
+        copy2(src, dest)
+
+
+def _link_tree(src, dest):
+    for root, dirs, files in os.walk(src):
+        dest_root = path_join(dest, os.path.relpath(root, src))
+        os.makedirs(dest_root, exist_ok=True)
+
+        for file_name in files:
+            _link(path_join(root, file_name), path_join(dest_root, file_name))
+
+
+def _make_read_only(path):
+    for root, dirs, files in os.walk(path):
+        for file_name in files:
+            file_path = path_join(root, file_name)
+
+            if not os.path.islink(file_path):
+                os.chmod(file_path, stat.S_IMODE(os.stat(file_path).st_mode) & 0o555)
+
+
+def _download(file_name, fetch):
+    """
+    Download the package into the store, the package's lock has to be held exclusively.
+    """
+    tmp_path = path_join(SHARED_PACKAGE_STORE, '.tmp-{}'.format(uuid4().hex))
+
+    try:
+        fetch(tmp_path)
+        _make_read_only(tmp_path)
+    except BaseException:
+        rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    os.makedirs(path_join(SHARED_PACKAGE_STORE, '.refs'), exist_ok=True)
+
+    with open(_ref_path(file_name), 'w'):
+        pass
+
+    os.rename(tmp_path, path_join(SHARED_PACKAGE_STORE, file_name))
+
+
+def link_package(file_name, entry_path, fetch):
+    """
+    Put the package into `entry_path`/package as hard links to the files in the store and reference
+    the package from `entry_path`/store-ref. When the package is not in the store yet, it is downloaded
+    by calling `fetch` with the destination path, while the other instances wait for it.
+    """
+    store_path = path_join(SHARED_PACKAGE_STORE, file_name)
+    downloaded = False
+
+    # many instances may link the package at the same time
+    fd = _lock(file_name, fcntl.LOCK_SH)
+
+    try:
+        if not isdir(store_path):
+            # the lock can not be upgraded atomically, so somebody else may be faster
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+            if not isdir(store_path):
+                logging.info('Downloading package {} into the shared store'.format(file_name))
+                _download(file_name, fetch)
+                downloaded = True
+
+        _link_tree(store_path, path_join(entry_path, 'package'))
+        _link(_ref_path(file_name), path_join(entry_path, 'store-ref'))
+        os.utime(store_path, None)
+    finally:
+        _unlock(fd)
+
+    if downloaded:
+        prune_store()
+
+
+def references(file_name):
+    """
+    :return how many package cache entries of the instances refer to the package
+    """
+    try:
+        return os.stat(_ref_path(file_name)).st_nlink - 1
+    except FileNotFoundError:
+        return 0
+
+
+def prune_store():
+    """
+    Remove the least recently used packages which are not referenced by any instance,
+    until the store fits into SHARED_PACKAGE_STORE_MAX_BYTES.
+    """
+    packages = []
+
+    for file_name in os.listdir(SHARED_PACKAGE_STORE):
+        path = path_join(SHARED_PACKAGE_STORE, file_name)
+
+        if file_name.startswith('.tmp-') and getmtime(path) + ABANDONED_DOWNLOAD_AGE < time():
+            rmtree(path, ignore_errors=True)
+        elif not file_name.startswith('.') and isdir(path):
+            packages.append((getmtime(path), file_name, directory_size(path)))
+
+    total_size = sum(size for mtime, file_name, size in packages)
+
+    for mtime, file_name, size in sorted(packages):
+        if total_size <= SHARED_PACKAGE_STORE_MAX_BYTES:
+            break
+
+        if references(file_name):
+            continue
+
+        try:
+            # the package is being linked by some instance
+            fd = _lock(file_name, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            continue
+
+        try:
+            if not references(file_name):
+                logging.info('Removing unused package from the shared store: {}'.format(file_name))
+                rmtree(path_join(SHARED_PACKAGE_STORE, file_name))
+                os.remove(_ref_path(file_name))
+                total_size -= size
+        finally:
+            _unlock(fd)
+
+
+def invalidate(file_name):
+    """
+    Remove the package from the store, unless it is still used by some instance.
+    :return True if the package is not in the store anymore
+    """
+    fd = _lock(file_name, fcntl.LOCK_EX)
+
+    try:
+        if references(file_name):
+            return False
+
+        rmtree(path_join(SHARED_PACKAGE_STORE, file_name), ignore_errors=True)
+
+        if os.path.exists(_ref_path(file_name)):
+            os.remove(_ref_path(file_name))
+
+        return True
+    finally:
+        _unlock(fd)
@@ -0,0 +1,213 @@
+import json
+import logging
+
+import task_queue
+from task_queue import rs_cli, alive_key
+from tuples import FinalResult
+from worker_conf import REDIS_QUEUE_KEY
+from workdir import slot_name
+
+"""
+Queues of the submissions, from the highest priority. Each list has a sorted set "<list>:order"
+with the uuids of its submissions. A claimed submission is kept in the processing list
+"<REDIS_QUEUE_KEY>:processing:<slot>" until its result is published.
+"""
+QUEUE_KEYS = [REDIS_QUEUE_KEY + ":high", REDIS_QUEUE_KEY + ":medium", REDIS_QUEUE_KEY + ":low"]
+
+"""
+After adding a submission to a queue, any value should be pushed into this list, which wakes up
+one of the idle slots. Without it, the submission is found when the idle slots look into the queues
+at least once per QUEUE_WAKEUP_TIMEOUT_SEC.
+"""
+WAKEUP_KEY = REDIS_QUEUE_KEY + ":wakeup"
+
+"""
+How many times each queued submission was claimed, by its uuid. Unlike the claim, the count
+survives putting the submission back to the queue.
+"""
+ATTEMPTS_KEY = REDIS_QUEUE_KEY + ":attempts"
+
+"""
+Submissions claimed more times than this are never processed successfully, e.g. because they crash
+the worker, so they get the internal_error result instead of being claimed again.
+"""
+MAX_ATTEMPTS = 3
+
+"""
+Pop up to ARGV[1] submissions from the queues KEYS[3], KEYS[5], ... (by priority), remove them
+from the sorted sets KEYS[4], KEYS[6], ... and push them into the processing list KEYS[1],
+together with the queue and the score they were taken from, so they can be put back.
+The attempts of each submission are counted in the hash KEYS[2].
+"""
+_claim_script = rs_cli.register_script("""
+local claimed = {}
+local count = tonumber(ARGV[1])
+
+for i = 3, #KEYS, 2 do
+    while #claimed < count do
+        local item = redis.call('LPOP', KEYS[i])
+
+        if not item then
+            break
+        end
+
+        local score = false
+        local uuid = false
+        local attempts = false
+        local ok, submission = pcall(cjson.decode, item)
+
+        if ok and type(submission) == 'table' and submission['uuid'] then
+            uuid = tostring(submission['uuid'])
+            score = redis.call('ZSCORE', KEYS[i + 1], uuid)
+            redis.call('ZREM', KEYS[i + 1], uuid)
+            attempts = redis.call('HINCRBY', KEYS[2], uuid, 1)
+        end
+
+        local entry = cjson.encode({queue = KEYS[i], score = score, uuid = uuid, attempts = attempts, data = item})
+        redis.call('RPUSH', KEYS[1], entry)
+        table.insert(claimed, entry)
+    end
+end
+
+return claimed
+""")
+
+"""
+Put all submissions of the processing list KEYS[1] back to the front of the queues they were claimed from
+and wake up an idle slot for each of them through the list KEYS[3]. When ARGV[1] is "1", it is done only
+if the alive key KEYS[2] of the slot which claimed them does not exist.
+"""
+_requeue_script = rs_cli.register_script("""
+if ARGV[1] == '1' and redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+
+local count = 0
+
+while true do
+    local entry = redis.call('RPOP', KEYS[1])
+
+    if not entry then
+        break
+    end
+
+    local claim = cjson.decode(entry)
+    redis.call('LPUSH', claim['queue'], claim['data'])
+    redis.call('RPUSH', KEYS[3], '1')
+
+    if claim['score'] then
+        redis.call('ZADD', claim['queue'] .. ':order', claim['score'], tostring(cjson.decode(claim['data'])['uuid']))
+    end
+
+    count = count + 1
+end
+
+return count
+""")
+
+
+def _processing_key(name):
+    return REDIS_QUEUE_KEY + ":processing:{}".format(name)
+
+
+def _reject(claim, entry):
+    """
+    Publish the internal_error result of the submission which was claimed too many times and drop it.
+    """
+    logging.error('Submission {} was claimed {} times without a result, giving up.'
+                  .format(entry['uuid'], entry['attempts']))
+    message = 'The submission was claimed {} times, but its processing never finished.'.format(entry['attempts'])
+    task_queue.send_report_async(FinalResult("internal_error", uuid=entry['uuid'], checked_by=slot_name(),
+                                             message=message))
+    do_complete(claim)
+    task_queue.remove_submission(entry['uuid'])
+
+
+def do_claim(count):
+    """
+    Atomically move up to `count` submissions from the queues into the processing list of the current slot.
+    :return claims and data of the submissions, without waiting if there are none
+    """
+    keys = [_processing_key(slot_name()), ATTEMPTS_KEY]
+
+    for queue_key in QUEUE_KEYS:
+        keys += [queue_key, queue_key + ":order"]
+
+    claimed = []
+
+    for entry in _claim_script(keys=keys, args=[count]):
+        claim = entry.decode('utf-8')
+        entry = json.loads(claim)
+
+        if entry['score'] is False:
+            logging.warning('Failed to remove submission from {}:order'.format(entry['queue']))
+
+        if entry['attempts'] and entry['attempts'] > MAX_ATTEMPTS:
+            _reject(claim, entry)
+        else:
+            claimed.append((claim, entry['data']))
+
+    return claimed
+
+
+def do_wait(timeout):
+    """
+    Block until an idle slot is woken up through WAKEUP_KEY, but at most `timeout` seconds.
+    """
+    rs_cli.blpop([WAKEUP_KEY], timeout)
+
+
+def do_complete(claim):
+    uuid = json.loads(claim).get('uuid')
+
+    pipe = rs_cli.pipeline(transaction=True)
+    # LREM has different arguments in the versions of the client
+    pipe.execute_command('LREM', _processing_key(slot_name()), 1, claim)
+
+    if uuid:
+        pipe.hdel(ATTEMPTS_KEY, uuid)
+
+    pipe.execute()
+
+
+def do_recover():
+    """
+    Put the submissions left in the processing list of the current slot by the previous run
+    of the instance back to the queues.
+    """
+    count = _requeue_script(keys=[_processing_key(slot_name()), '', WAKEUP_KEY], args=['0'])
+
+    if count:
+        logging.warning('Returned {} unfinished submissions of the previous run to the queue.'.format(count))
+
+
+def do_maintain(claims):
+    """
+    Put the submissions claimed by the slots which do not send beats anymore back to the queues.
+    """
+    prefix = _processing_key('')
+
+    for key in rs_cli.scan_iter(match=prefix + '*'):
+        name = key.decode('utf-8')[len(prefix):]
+        count = _requeue_script(keys=[key, alive_key(name), WAKEUP_KEY], args=['1'])
+
+        if count:
+            logging.warning('Returned {} submissions abandoned by dead worker {} to the queue.'.format(count, name))
+
+
+def do_publish_result(report):
+    """
+    Publish the final result on the "reports" channel, it is lost when nobody is subscribed.
+    :return True if somebody received the result
+    """
+    count = rs_cli.publish("reports", report)
+
+    if not count:
+        logging.error('Final report was published but no clients had received this message.')
+        return False
+
+    logging.info('Final result was published successfully (recipients: %d).', count)
+    return True
+
+
+__plugin__ = {}
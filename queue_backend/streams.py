@@ -0,0 +1,242 @@
+import json
+import logging
+
+from redis import ResponseError
+
+import task_queue
+from task_queue import rs_cli, BEAT_EXPIRE
+from tuples import FinalResult
+from worker_conf import REDIS_QUEUE_KEY
+from workdir import slot_name
+
+"""
+Queues of the submissions in Redis Streams, from the highest priority. The submissions are added by
+XADD <stream> * data <submission JSON> and read by the consumer group GROUP, each slot is a consumer
+under its own name. A submission stays in the consumer's pending entries list until its result
+is published, so it is processed at least once even if the worker crashes.
+"""
+STREAM_KEYS = [REDIS_QUEUE_KEY + ":stream:high", REDIS_QUEUE_KEY + ":stream:medium",
+               REDIS_QUEUE_KEY + ":stream:low"]
+GROUP = "workers"
+
+"""
+The final results are added to this stream as "data" fields, the oldest ones are trimmed
+when the stream is longer than about REPORTS_MAXLEN entries.
+"""
+REPORTS_STREAM = REDIS_QUEUE_KEY + ":reports"
+REPORTS_MAXLEN = 100000
+
+"""
+Submissions pending for longer than this (in milliseconds) were claimed by dead workers, the live ones
+renew their claims with every heartbeat.
+"""
+ABANDONED_IDLE_MS = BEAT_EXPIRE * 1000
+
+"""
+Submissions delivered more times than this are never processed successfully, e.g. because they crash
+the worker, so they get the internal_error result instead of being delivered again.
+"""
+MAX_DELIVERIES = 3
+
+"""
+How many pending submissions of the previous run of a slot are taken back at most.
+"""
+RECOVER_COUNT = 1000
+
+"""
+Claim up to ARGV[3] submissions from the streams KEYS (by priority) for the consumer ARGV[2]
+of the group ARGV[1]. With ARGV[5] = ">", the submissions pending for more than ARGV[4] ms
+are taken over first and then the new ones are read, with ARGV[5] = "0" the submissions
+already pending for the consumer are read. Each claim tells how many times the submission
+was delivered. Scripts can not block, so the streams are polled.
+"""
+_claim_script = rs_cli.register_script("""
+local claimed = {}
+local count = tonumber(ARGV[3])
+
+local function take(stream, entries)
+    for _, entry in ipairs(entries) do
+        local data = false
+
+        if type(entry) == 'table' and type(entry[2]) == 'table' then
+            for i = 1, #entry[2], 2 do
+                if entry[2][i] == 'data' then
+                    data = entry[2][i + 1]
+                end
+            end
+        end
+
+        if data then
+            local deliveries = redis.call('XPENDING', stream, ARGV[1], entry[1], entry[1], 1)[1][4]
+            table.insert(claimed, cjson.encode({stream = stream, id = entry[1], consumer = ARGV[2], data = data,
+                                                deliveries = deliveries}))
+        elseif type(entry) == 'table' then
+            -- the entry was deleted or it is not a submission, so it can never be processed
+            redis.call('XACK', stream, ARGV[1], entry[1])
+        end
+    end
+end
+
+for _, stream in ipairs(KEYS) do
+    if #claimed >= count then
+        break
+    end
+
+    if ARGV[5] == '>' then
+        take(stream, redis.call('XAUTOCLAIM', stream, ARGV[1], ARGV[2], ARGV[4], '0-0', 'COUNT', count - #claimed)[2])
+    end
+
+    if #claimed < count then
+        local read = redis.call('XREADGROUP', 'GROUP', ARGV[1], ARGV[2], 'COUNT', count - #claimed,
+                                'STREAMS', stream, ARGV[5])
+
+        if read and read[1] then
+            take(stream, read[1][2])
+        end
+    end
+end
+
+return claimed
+""")
+
+"""
+Reset the idle time of the entries which are still pending for the consumers that claimed them, KEYS[i]
+is the stream of the i-th entry, ARGV[2 * i] and ARGV[2 * i + 1] are its consumer and id in the group ARGV[1].
+"""
+_renew_script = rs_cli.register_script("""
+for i = 1, #KEYS do
+    local consumer = ARGV[2 * i]
+    local id = ARGV[2 * i + 1]
+
+    if #redis.call('XPENDING', KEYS[i], ARGV[1], id, id, 1, consumer) > 0 then
+        redis.call('XCLAIM', KEYS[i], ARGV[1], consumer, 0, id, 'JUSTID')
+    end
+end
+
+return #KEYS
+""")
+
+_groups_created = False
+
+"""
+Submissions of the previous run of the slot, by the name of the slot, which are handed out before the new ones.
+"""
+_recovered = {}
+
+
+def _create_groups():
+    global _groups_created
+
+    if _groups_created:
+        return
+
+    for stream in STREAM_KEYS:
+        try:
+            rs_cli.execute_command('XGROUP', 'CREATE', stream, GROUP, '0', 'MKSTREAM')
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    _groups_created = True
+
+
+def _reject(claim, entry):
+    """
+    Publish the internal_error result of the submission which was delivered too many times and drop it.
+    """
+    try:
+        s_uuid = json.loads(entry['data'])['uuid']
+    except (ValueError, TypeError, KeyError):
+        s_uuid = None
+
+    logging.error('Submission {} was delivered {} times without a result, giving up.'
+                  .format(s_uuid, entry['deliveries']))
+    message = 'The submission was delivered {} times, but its processing never finished.'.format(entry['deliveries'])
+    task_queue.send_report_async(FinalResult("internal_error", uuid=s_uuid, checked_by=slot_name(), message=message))
+    do_complete(claim)
+
+    if s_uuid is not None:
+        task_queue.remove_submission(s_uuid)
+
+
+def _claim(count, start_id):
+    _create_groups()
+    claimed = []
+
+    for claim in _claim_script(keys=STREAM_KEYS, args=[GROUP, slot_name(), count, ABANDONED_IDLE_MS, start_id]):
+        claim = claim.decode('utf-8')
+        entry = json.loads(claim)
+
+        if entry['deliveries'] > MAX_DELIVERIES:
+            _reject(claim, entry)
+        else:
+            claimed.append((claim, entry['data']))
+
+    return claimed
+
+
+def do_claim(count):
+    """
+    Read up to `count` submissions for the current slot, the ones abandoned by dead workers first.
+    :return claims and data of the submissions, without waiting if there are none
+    """
+    recovered = _recovered.get(slot_name())
+
+    if recovered:
+        claimed = recovered[:count]
+        del recovered[:count]
+        return claimed
+
+    return _claim(count, '>')
+
+
+def do_complete(claim):
+    claim = json.loads(claim)
+
+    pipe = rs_cli.pipeline(transaction=True)
+    pipe.execute_command('XACK', claim['stream'], GROUP, claim['id'])
+    pipe.execute_command('XDEL', claim['stream'], claim['id'])
+    pipe.execute()
+
+
+def do_recover():
+    """
+    Take back the submissions which are still pending for the current slot since the previous run of the instance.
+    """
+    _recovered[slot_name()] = _claim(RECOVER_COUNT, '0')
+
+    if _recovered[slot_name()]:
+        logging.warning('Taking back {} unfinished submissions of the previous run.'
+                        .format(len(_recovered[slot_name()])))
+
+
+def do_maintain(claims):
+    """
+    Renew the claims of the submissions being processed, so they are not taken over by other workers.
+    The submissions of dead workers are taken over by XAUTOCLAIM when the idle slots claim new ones.
+    """
+    if not claims:
+        return
+
+    keys = []
+    args = [GROUP]
+
+    for claim in claims:
+        claim = json.loads(claim)
+        keys.append(claim['stream'])
+        args += [claim['consumer'], claim['id']]
+
+    _renew_script(keys=keys, args=args)
+
+
+def do_publish_result(report):
+    """
+    Add the final result to the reports stream, where it is kept until it is read, even if nobody is listening now.
+    :return True
+    """
+    entry_id = rs_cli.execute_command('XADD', REPORTS_STREAM, 'MAXLEN', '~', REPORTS_MAXLEN, '*', 'data', report)
+    logging.info('Final result was added to {} as {}.'.format(REPORTS_STREAM, entry_id.decode('utf-8')))
+    return True
+
+
+__plugin__ = {}
@@ -1,15 +1,14 @@
-import json
 import os
+from uuid import uuid4
 
-from shutil import rmtree, copy
+from shutil import rmtree
 
-from os import path, makedirs, chmod, walk
-
-from container import make_container, chown_recursive, docker_cli, file_spinlock, reset_memory_peak, quickly_get_stats, \
-    QuickStatsNotAvailable, destroy_container
-from tuples import ExecStatus
+from container import make_container, docker_cli, file_spinlock, reset_memory_peak, quickly_get_stats, \
+    QuickStatsNotAvailable, destroy_container, pool_acquire, fifo_signal, reap_container, container_logs
+from runners.common import binds, host_config, prepare_location, make_result, wall_limit_sec, wait_for_result, \
+    mark_started, abort_test, write_output_limit
+from tuples import PooledContainer
 from workdir import internal_path
-from worker_conf import DOCKER_CONTAINER_USER, DOCKER_CONTAINER_GROUP
 
 wrapper_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "bin", "run-bin.sh")
 
@@ -18,69 +17,49 @@ def command():
     return ['/mnt/scripts/run.sh']
 
 
-def binds(real_location, additional_binds=None):
-    base_binds = {
-        internal_path(os.path.join(real_location, "scripts")): {
-            "bind": "/mnt/scripts",
-            "mode": "ro"
-        },
-        internal_path(os.path.join(real_location, "in")): {
-            "bind": "/mnt/in",
-            "mode": "ro"
-        },
-        internal_path(os.path.join(real_location, "out")): {
-            "bind": "/mnt/out",
-            "mode": "rw"
-        },
-        internal_path(os.path.join(real_location, "data")): {
-            "bind": "/mnt/data",
-            "mode": "rw"
-        }
-    }
-
-    if additional_binds:
-        base_binds.update(additional_binds)
-
-    return base_binds
-
-
-def host_config(package_config):
-    return {
-        "mem_limit": package_config['limits']['max_memory'],
-        "cpu_quota": package_config['limits']['cpu_quota'],
-        "cpu_period": package_config['limits']['cpu_period'],
-        "network_mode": "none"
-    }
+def pool_key(runner_conf):
+    return 'bin', runner_conf['image'], tuple(sorted(host_config(runner_conf).items()))
 
 
-def do_prepare(runner_conf):
-    real_location = runner_conf['location']
+def make_pooled_container(runner_conf):
+    real_location = os.path.join('pool', uuid4().hex)
+    prepare_location(real_location, {'run.sh': wrapper_path})
 
-    rmtree(internal_path(real_location), ignore_errors=True)
+    container = make_container(runner_conf['image'], command(), binds(real_location), host_config(runner_conf),
+                               pooled=True)
+    docker_cli.start(container)
+
+    return PooledContainer(container, real_location)
 
-    # create working directory "data"
-    makedirs(internal_path(os.path.join(real_location, 'data')))
 
-    # create the directory for runner's input and output
-    makedirs(internal_path(os.path.join(real_location, 'in')))
-    makedirs(internal_path(os.path.join(real_location, 'out')))
+def do_prepare(runner_conf):
+    if runner_conf['pool']:
+        pool_conf = dict(runner_conf)
+        pooled = pool_acquire(pool_key(runner_conf), lambda: make_pooled_container(pool_conf))
 
-    # create the directory for all necessary scripts
-    makedirs(internal_path(os.path.join(real_location, 'scripts')))
-    # copy the wrapper script which would be used as container's starting command
-    copy(wrapper_path, internal_path(os.path.join(real_location, 'scripts/run.sh')))
+        if pooled:
+            # the container is already running, the test has to be set up inside its own location
+            runner_conf['location'] = pooled.location
+            runner_conf['pooled_container'] = pooled.container
+            write_output_limit(runner_conf)
+            return
 
-    # make sure that the container starting command is executable
-    chmod(internal_path(os.path.join(real_location, 'scripts/run.sh')), 0o500)
-    # ensure that exec_user will have the proper permissions
-    chown_recursive(internal_path(real_location), DOCKER_CONTAINER_USER, DOCKER_CONTAINER_GROUP)
+    prepare_location(runner_conf['location'], {'run.sh': wrapper_path})
+    write_output_limit(runner_conf)
 
 
 def do_run(runner_conf, additional_binds=None):
     real_location = runner_conf['location']
 
-    container = make_container(runner_conf['image'], command(), binds(real_location, additional_binds), host_config(runner_conf))
-    docker_cli.start(container)
+    if 'pooled_container' in runner_conf:
+        if additional_binds:
+            raise RuntimeError('Additional binds can not be applied to a container taken from the pool.')
+
+        container = runner_conf['pooled_container']
+    else:
+        container = make_container(runner_conf['image'], command(), binds(real_location, additional_binds),
+                                   host_config(runner_conf))
+        docker_cli.start(container)
 
     # wait until runner says it's ready
     if not file_spinlock(internal_path(os.path.join(real_location, 'out/ready')), 1.0):
@@ -92,17 +71,19 @@ def do_run(runner_conf, additional_binds=None):
     reset_memory_peak(container)
 
     # tell runner that it can begin the test
-    open(internal_path(os.path.join(real_location, 'in/ready_ok')), 'w').close()
+    mark_started(runner_conf)
+    fifo_signal(internal_path(os.path.join(real_location, 'scripts/go')))
     return container
 
 
 def do_wait(runner_conf, container, max_time=None):
     real_location = runner_conf['location']
 
-    # wait (timeout + 0.2) seconds for the runner to indicate that the work is finished
+    # wait (timeout + 0.5) seconds, or longer when the CPU time is judged,
+    # for the runner to indicate that the work is finished
     # if it would not finish within that time, we destroy the container and say that
     # this test is hitting "hard_timeout"
-    limit_sec = (float(runner_conf['limits']['timeout']) / 1000.0) + 0.5
+    limit_sec = wall_limit_sec(runner_conf)
 
     if max_time:
         limit_sec = min(limit_sec, max_time)
@@ -114,32 +95,37 @@ def do_wait(runner_conf, container, max_time=None):
     try:
         stats = quickly_get_stats(container)
     except QuickStatsNotAvailable:
-        stats = docker_cli.stats(container=container, decode=True, stream=False)
+        # docker stats would take seconds, rather report the test without memory usage
+        stats = None
 
-    stdout, stderr = destroy_container(container)
-    return make_result(runner_conf, stdout, stderr, stats, test_finished)
+    if not test_finished or runner_conf.get('aborted'):
+        # the program may still be writing into the location, which is going to be reused
+        destroy_container(container, collect_logs=False)
+        return make_result(runner_conf, None, stats, test_finished)
 
+    result = wait_for_result(runner_conf, lambda: container_logs(container))
 
-def make_result(runner_conf, stdout, stderr, stats, test_finished):
-    used_memory = stats['memory_stats']['max_usage'] if stats else None
-    timeout_ms = int(runner_conf['limits']['timeout'])
+    if result is None:
+        # the program pretended to be finished, but it is still running
+        destroy_container(container, collect_logs=False)
+        return make_result(runner_conf, None, stats, False)
 
-    # the test was interrupted after exceeding the allowed time
-    if not test_finished:
-        exec_limit_ms = timeout_ms + 500
-        return ExecStatus('hard_timeout', timeout=timeout_ms, exec_time=exec_limit_ms, memory=used_memory)
+    # only the wrapper script is left running, the container may be removed in the background
+    reap_container(container)
+    return make_result(runner_conf, result, stats, test_finished)
 
-    # load the JSON which wrapper script should basically output to its' stdout
-    res = json.loads(stdout)
 
-    if res['exit_code'] == 0 and res['exec_time'] < timeout_ms:
-        status = 'ok'
-    elif res['exit_code'] != 0:
-        status = 'bad_exit_code'
-    else:
-        status = 'soft_timeout'
+def do_abort(runner_conf):
+    """
+    Stop the running test before it finishes, do_wait returns the "aborted" status then.
+    """
+    abort_test(runner_conf)
+
 
-    return ExecStatus(status, timeout_ms, res['exit_code'], res['exec_time'], used_memory)
+def do_cleanup(runner_conf):
+    # locations of pooled containers are used only once
+    if 'pooled_container' in runner_conf:
+        rmtree(internal_path(runner_conf['location']), ignore_errors=True)
 
 
 __plugin__ = {
@@ -4,21 +4,37 @@
 # otherwise there may be some very strange problems
 
 cd /mnt/data
+
+# keep the FIFO open before saying "ready", so the host can signal it without blocking
+exec 3<> /mnt/scripts/go
 touch /mnt/out/ready
+read -r -u 3
+exec 3<&-
+
+# bash reports wall, user and system time of the program (as returned by wait4) in seconds
+TIMEFORMAT='%3R %3U %3S'
+# the size of each file written by the program (not their total size) is limited only within
+# the subshell running it
+TIMES=$( {
+    if [ -f /mnt/scripts/output_limit ]; then
+        ulimit -f "$(< /mnt/scripts/output_limit)"
+    fi
+    time /mnt/in/prog < /mnt/in/input.txt > /mnt/out/output.txt 2> /mnt/out/error.txt ;
+} 2>&1 )
+EXITCODE=$?
 
-while [ ! -f /mnt/in/ready_ok ]
-do
-    sleep 0.01
-done
+read -r WALL_TIME USER_TIME SYS_TIME <<< "$TIMES"
 
-TIMESTART=`date +%s%N`
-/mnt/in/prog < /mnt/in/input.txt > /mnt/out/output.txt 2> /mnt/out/error.txt
-EXITCODE=$?
-TIMEEND=`date +%s%N`
+# "1.234" -> 1234 (milliseconds)
+to_ms() {
+    echo $((10#${1/./}))
+}
 
-TIME=`expr \( $TIMEEND - $TIMESTART \) / 1000000`
+TIME=$(to_ms $WALL_TIME)
+CPU_TIME=$(( $(to_ms $USER_TIME) + $(to_ms $SYS_TIME) ))
 
-echo "{\"exit_code\": $EXITCODE, \"exec_time\": $TIME}"
+# the result goes to the standard output of the wrapper, which the program can not write into
+echo "{\"exit_code\": $EXITCODE, \"exec_time\": $TIME, \"cpu_time\": $CPU_TIME}"
 
 touch /mnt/out/finished
 
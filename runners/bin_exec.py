@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+
+import cgroup
+from container import make_container, docker_cli, file_spinlock, reset_memory_peak, quickly_get_stats, \
+    QuickStatsNotAvailable, reap_container
+from runners.common import binds, host_config, prepare_location, make_result, wall_limit_sec, wait_for_result, \
+    mark_started, abort_test, write_output_limit, MAX_RESULT_BYTES
+from workdir import internal_path, clear_directory
+
+wrapper_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "bin_exec", "run-test.sh")
+
+"""
+Sandbox containers which are kept running between the tests, together with their binds, by the host path
+of the runner's location, which is different for each submission slot.
+"""
+_sandboxes = {}
+
+_per_test_warned = False
+
+
+def command():
+    # the sandbox only has to stay alive, every test is started through "docker exec"
+    return ['sleep', 'infinity']
+
+
+def do_prepare(runner_conf):
+    real_location = runner_conf['location']
+
+    if internal_path(real_location) in _sandboxes:
+        # the sandbox is reused, so only leftovers from the previous test are removed
+        clear_directory(internal_path(os.path.join(real_location, 'out')))
+    else:
+        prepare_location(real_location, {'run-test.sh': wrapper_path})
+
+    write_output_limit(runner_conf)
+
+
+def _reusable():
+    """
+    A sandbox may be reused only with the same binds and when its memory peak can be reset before each test,
+    otherwise the peaks of all tests would add up.
+    """
+    global _per_test_warned
+
+    if not cgroup.peak_reset_supported():
+        if not _per_test_warned:
+            _per_test_warned = True
+            logging.warning('The peak memory usage can not be reset on this host, '
+                            'bin_exec will start a new sandbox for every test.')
+
+        return False
+
+    return True
+
+
+def do_run(runner_conf, additional_binds=None):
+    real_location = runner_conf['location']
+    sandbox_binds = binds(real_location, additional_binds)
+    container, container_binds = _sandboxes.get(internal_path(real_location), (None, None))
+
+    if container and (container_binds != sandbox_binds or not _reusable()):
+        del _sandboxes[internal_path(real_location)]
+        reap_container(container)
+        container = None
+
+    if not container:
+        container = make_container(runner_conf['image'], command(), sandbox_binds, host_config(runner_conf))
+        docker_cli.start(container)
+        _sandboxes[internal_path(real_location)] = (container, sandbox_binds)
+
+    # the sandbox is shared between the tests, so the peak has to be measured from now on
+    reset_memory_peak(container)
+
+    exec_id = docker_cli.exec_create(container, ['/mnt/scripts/run-test.sh'], stdout=True, stderr=False)
+    mark_started(runner_conf)
+
+    # the result record comes through the standard output of the wrapper script
+    runner_conf['wrapper_output'] = []
+    threading.Thread(target=_collect_output, args=(docker_cli.exec_start(exec_id, stream=True),
+                                                   runner_conf['wrapper_output']), daemon=True).start()
+    return container
+
+
+def _collect_output(stream, chunks):
+    """
+    Read the whole output of the wrapper script, but keep only its beginning.
+    """
+    size = 0
+
+    for chunk in stream:
+        if size <= MAX_RESULT_BYTES:
+            chunks.append(chunk)
+            size += len(chunk)
+
+
+def kill_test(container):
+    """
+    Kill everything what was started inside of the sandbox by the test, the sandbox itself
+    is the init process of the container, so it is not affected.
+    """
+    exec_id = docker_cli.exec_create(container, ['/bin/bash', '-c', 'kill -9 -1'])
+    docker_cli.exec_start(exec_id)
+
+
+def do_wait(runner_conf, container, max_time=None):
+    real_location = runner_conf['location']
+
+    limit_sec = wall_limit_sec(runner_conf)
+
+    if max_time:
+        limit_sec = min(limit_sec, max_time)
+
+    test_finished = file_spinlock(internal_path(os.path.join(real_location, 'out/finished')), limit_sec)
+
+    try:
+        stats = quickly_get_stats(container)
+    except QuickStatsNotAvailable:
+        # docker stats would take seconds, rather report the test without memory usage
+        stats = None
+
+    if not test_finished or runner_conf.get('aborted'):
+        kill_test(container)
+        return make_result(runner_conf, None, stats, test_finished)
+
+    result = wait_for_result(runner_conf, lambda: b''.join(runner_conf['wrapper_output']).decode(errors='replace'))
+
+    if result is None:
+        # the program pretended to be finished, but it is still running
+        kill_test(container)
+        return make_result(runner_conf, None, stats, False)
+
+    return make_result(runner_conf, result, stats, test_finished)
+
+
+def do_abort(runner_conf):
+    """
+    Stop the running test before it finishes, do_wait returns the "aborted" status then.
+    """
+    abort_test(runner_conf)
+
+
+def do_cleanup(runner_conf):
+    pass
+
+
+def do_teardown():
+    """
+    Destroy all sandboxes of the current submission slot after the last test of the submission.
+    """
+    slot_work_dir = internal_path('work') + os.sep
+
+    for location_path, (container, container_binds) in list(_sandboxes.items()):
+        if location_path.startswith(slot_work_dir):
+            del _sandboxes[location_path]
+            reap_container(container)
+
+
+__plugin__ = {
+    "required_images": []
+}
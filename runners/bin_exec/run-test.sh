@@ -0,0 +1,38 @@
+#!/bin/bash
+
+# Remember that in such scripts line feeds MUST BE LF
+# otherwise there may be some very strange problems
+
+# executed through "docker exec" inside of the sandbox, once per test
+
+cd /mnt/data
+
+# bash reports wall, user and system time of the program (as returned by wait4) in seconds
+TIMEFORMAT='%3R %3U %3S'
+# the size of each file written by the program (not their total size) is limited only within
+# the subshell running it
+TIMES=$( {
+    if [ -f /mnt/scripts/output_limit ]; then
+        ulimit -f "$(< /mnt/scripts/output_limit)"
+    fi
+    time /mnt/in/prog < /mnt/in/input.txt > /mnt/out/output.txt 2> /mnt/out/error.txt ;
+} 2>&1 )
+EXITCODE=$?
+
+read -r WALL_TIME USER_TIME SYS_TIME <<< "$TIMES"
+
+# "1.234" -> 1234 (milliseconds)
+to_ms() {
+    echo $((10#${1/./}))
+}
+
+TIME=$(to_ms $WALL_TIME)
+CPU_TIME=$(( $(to_ms $USER_TIME) + $(to_ms $SYS_TIME) ))
+
+# the result goes to the standard output of the wrapper, which the program can not write into
+echo "{\"exit_code\": $EXITCODE, \"exec_time\": $TIME, \"cpu_time\": $CPU_TIME}"
+
+# do not let anything started by the program survive until the next test
+kill -9 -1 2> /dev/null
+
+touch /mnt/out/finished
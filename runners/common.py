@@ -0,0 +1,263 @@
+import json
+import math
+import os
+import signal
+from time import monotonic, sleep
+
+from shutil import rmtree, copy
+
+from os import makedirs, chmod, mkfifo
+
+from container import chown_recursive
+from tuples import ExecStatus
+from workdir import internal_path
+from worker_conf import DOCKER_CONTAINER_USER, DOCKER_CONTAINER_GROUP
+
+"""
+Output limit used when the "limits" of the runner do not mention max_output_bytes, the output is not limited
+unless a package asks for it.
+"""
+DEFAULT_MAX_OUTPUT_BYTES = None
+
+
+"""
+The result record printed by the wrapper script is a short line, longer lines are not result records.
+"""
+MAX_RESULT_BYTES = 1024
+
+"""
+How often (in seconds) the output of the wrapper script is checked for the result record
+after out/finished appeared without it.
+"""
+RESULT_POLL_INTERVAL = 0.05
+
+
+def binds(real_location, additional_binds=None):
+    base_binds = {
+        internal_path(os.path.join(real_location, "scripts")): {
+            "bind": "/mnt/scripts",
+            "mode": "ro"
+        },
+        internal_path(os.path.join(real_location, "in")): {
+            "bind": "/mnt/in",
+            "mode": "ro"
+        },
+        internal_path(os.path.join(real_location, "out")): {
+            "bind": "/mnt/out",
+            "mode": "rw"
+        },
+        internal_path(os.path.join(real_location, "data")): {
+            "bind": "/mnt/data",
+            "mode": "rw"
+        }
+    }
+
+    if additional_binds:
+        base_binds.update(additional_binds)
+
+    return base_binds
+
+
+def host_config(package_config):
+    return {
+        "mem_limit": package_config['limits']['max_memory'],
+        "cpu_quota": package_config['limits']['cpu_quota'],
+        "cpu_period": package_config['limits']['cpu_period'],
+        "network_mode": "none"
+    }
+
+
+def prepare_location(real_location, scripts):
+    """
+    Create the directory layout of the runner's location. `scripts` maps the names under
+    which the scripts should be available in /mnt/scripts to their paths on the host.
+    """
+    rmtree(internal_path(real_location), ignore_errors=True)
+
+    # create working directory "data"
+    makedirs(internal_path(os.path.join(real_location, 'data')))
+
+    # create the directory for runner's input and output
+    makedirs(internal_path(os.path.join(real_location, 'in')))
+    makedirs(internal_path(os.path.join(real_location, 'out')))
+
+    # create the directory for all necessary scripts
+    makedirs(internal_path(os.path.join(real_location, 'scripts')))
+
+    for script_name, script_path in scripts.items():
+        script_dest = internal_path(os.path.join(real_location, 'scripts', script_name))
+        copy(script_path, script_dest)
+        # make sure that the script is executable
+        chmod(script_dest, 0o500)
+
+    # the wrapper script blocks on reading this FIFO until the test may begin, it is kept among
+    # the scripts because the environment clears "in" after the location is prepared; writing
+    # into a FIFO is allowed even though the scripts are mounted read-only
+    mkfifo(internal_path(os.path.join(real_location, 'scripts/go')), 0o600)
+
+    # ensure that exec_user will have the proper permissions
+    chown_recursive(internal_path(real_location), DOCKER_CONTAINER_USER, DOCKER_CONTAINER_GROUP)
+
+
+def wall_limit_sec(runner_conf):
+    """
+    How long the test may run before it is killed ("hard_timeout"). When the time is judged
+    by CPU time, the test has to be given more wall time, as it may be waiting for a CPU.
+    """
+    limits = runner_conf['limits']
+    limit_sec = float(limits['timeout']) / 1000.0
+
+    if limits.get('time_measure', 'wall') == 'cpu':
+        limit_sec *= float(limits.get('wall_time_factor', 3))
+
+    return limit_sec + 0.5
+
+
+def max_output_bytes(runner_conf):
+    """
+    :return how many bytes the program may write into a single file, or None if it is not limited;
+    "ulimit -f" limits each file separately, so the program may still write more into several files
+    """
+    limit = runner_conf['limits'].get('max_output_bytes', DEFAULT_MAX_OUTPUT_BYTES)
+    return int(limit) if limit else None
+
+
+def write_output_limit(runner_conf):
+    """
+    Tell the wrapper script how large files the program may write, in 1024 byte blocks as expected
+    by "ulimit -f". The limit is written among the scripts, so it is available to already running containers.
+    """
+    limit_path = internal_path(os.path.join(runner_conf['location'], 'scripts/output_limit'))
+    limit = max_output_bytes(runner_conf)
+
+    if not limit:
+        if os.path.exists(limit_path):
+            os.remove(limit_path)
+
+        return
+
+    with open(limit_path, 'w') as limit_file:
+        limit_file.write(str(math.ceil(limit / 1024)))
+
+    chmod(limit_path, 0o644)
+
+
+def output_limit_exceeded(runner_conf, result):
+    """
+    The program is killed by SIGXFSZ when it tries to write more than the limit, unless it handles
+    the signal, so the sizes of the outputs are checked too.
+    """
+    limit = max_output_bytes(runner_conf)
+
+    if not limit:
+        return False
+
+    if result['exit_code'] == 128 + signal.SIGXFSZ:
+        return True
+
+    for output_name in ['out/output.txt', 'out/error.txt']:
+        output_path = internal_path(os.path.join(runner_conf['location'], output_name))
+
+        # in the live mode the output is a FIFO, which is limited by the environment
+        if os.path.isfile(output_path) and os.path.getsize(output_path) > limit:
+            return True
+
+    return False
+
+
+def mark_started(runner_conf):
+    """
+    Remember when the test was started, to know how long it was running if it gets aborted.
+    """
+    runner_conf['started'] = monotonic()
+
+
+def abort_test(runner_conf):
+    """
+    Wake up do_wait as if the test has finished, do_wait then kills the test and reports it as "aborted".
+    May be called from any thread.
+    """
+    runner_conf['aborted'] = True
+
+    with open(internal_path(os.path.join(runner_conf['location'], 'out/finished')), 'a'):
+        pass
+
+
+def parse_result(output):
+    """
+    Find the result record, which the wrapper script prints as the last line of its standard output.
+    The program can not write there, unlike into /mnt/out.
+    :return dict or None if there is no valid result
+    """
+    lines = output.strip().splitlines()
+
+    if not lines or len(lines[-1]) > MAX_RESULT_BYTES:
+        return None
+
+    try:
+        result = json.loads(lines[-1])
+    except ValueError:
+        return None
+
+    if not isinstance(result, dict) or not isinstance(result.get('exit_code'), int) \
+            or not isinstance(result.get('exec_time'), int):
+        return None
+
+    return result
+
+
+def wait_for_result(runner_conf, read_output):
+    """
+    The program may create out/finished by itself, so the test is finished only when the wrapper
+    script has printed the result record. `read_output` returns the standard output of the wrapper.
+    :return the result record or None if it was not printed within the wall time limit of the test
+    """
+    deadline = runner_conf['started'] + wall_limit_sec(runner_conf)
+
+    while True:
+        result = parse_result(read_output())
+
+        if result is not None or monotonic() >= deadline:
+            return result
+
+        sleep(RESULT_POLL_INTERVAL)
+
+
+def make_result(runner_conf, result, stats, test_finished):
+    used_memory = stats['memory_stats']['max_usage'] if stats else None
+    timeout_ms = int(runner_conf['limits']['timeout'])
+
+    # the test was stopped by the environment, e.g. because its output was already wrong
+    if runner_conf.get('aborted'):
+        exec_ms = int((monotonic() - runner_conf['started']) * 1000)
+        return ExecStatus('aborted', timeout=timeout_ms, exec_time=exec_ms, memory=used_memory, wall_time=exec_ms)
+
+    # the test was interrupted after exceeding the allowed time
+    if not test_finished:
+        exec_limit_ms = int(wall_limit_sec(runner_conf) * 1000)
+        return ExecStatus('hard_timeout', timeout=timeout_ms, exec_time=exec_limit_ms, memory=used_memory,
+                          wall_time=exec_limit_ms)
+
+    wall_time = result['exec_time']
+    cpu_time = result.get('cpu_time')
+
+    if cpu_time is None and stats and stats['cpu_stats']['cpu_usage']['total_usage'] is not None:
+        # CPU time of the whole container, including the wrapper script
+        cpu_time = stats['cpu_stats']['cpu_usage']['total_usage'] // 1000000
+
+    # the time which is compared with the timeout
+    if runner_conf['limits'].get('time_measure', 'wall') == 'cpu' and cpu_time is not None:
+        exec_time = cpu_time
+    else:
+        exec_time = wall_time
+
+    if output_limit_exceeded(runner_conf, result):
+        status = 'output_limit_exceeded'
+    elif result['exit_code'] == 0 and exec_time < timeout_ms:
+        status = 'ok'
+    elif result['exit_code'] != 0:
+        status = 'bad_exit_code'
+    else:
+        status = 'soft_timeout'
+
+    return ExecStatus(status, timeout_ms, result['exit_code'], exec_time, used_memory, wall_time, cpu_time)
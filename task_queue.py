@@ -1,15 +1,21 @@
 import logging
 import json
-from os import makedirs
-from time import sleep, time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs, remove
+from time import sleep, time, monotonic
 from re import match
 from os.path import join as path_join, abspath as path_abspath
 from uuid import uuid4
+from zipfile import ZipFile, BadZipfile
 
-from redis import Redis, ConnectionError
+from redis import Redis, ConnectionError, ResponseError, RedisError
 from shutil import rmtree
 
-from worker_conf import REDIS_CONF, REDIS_QUEUE_KEY, INSTANCE_NAME
+import plugin_loader
+from worker_conf import REDIS_CONF, REDIS_QUEUE_KEY, STATUS_REPORT_INTERVAL_MS, HEARTBEAT_INTERVAL, \
+    QUEUE_POLL_INTERVAL_MS, QUEUE_WAKEUP_TIMEOUT_SEC, QUEUE_BACKEND
+from workdir import slot_name
 
 """
 Global instance of Redis client.
@@ -19,6 +25,60 @@ current_instance_uuid = uuid4()
 interrupted = False
 interrupt_count = 0
 
+"""
+Field of the submission or package hash, which may contain all of its files in a zip archive.
+"""
+ARCHIVE_FIELD = 'archive:zip'
+
+"""
+Files are fetched from Redis in batches of at most DOWNLOAD_BATCH_FILES files, which have
+at most DOWNLOAD_BATCH_BYTES bytes together, unless a single file is larger.
+"""
+DOWNLOAD_BATCH_FILES = 256
+DOWNLOAD_BATCH_BYTES = 8 * 1024 * 1024
+
+DOWNLOAD_WRITE_THREADS = 4
+
+"""
+Beats and partial statuses waiting for the reporter thread, by their Redis key. Only the latest
+value of each key is sent, so the reports made in between two flushes are coalesced.
+"""
+_pending_reports = {}
+_reports_cond = threading.Condition()
+_flush_lock = threading.Lock()
+_reporter = None
+
+"""
+What each submission slot of the instance is doing, by the name of the slot, as published
+in the beats. The heartbeat thread repeats the beats, so the slots do not look dead during
+long compilations or tests.
+"""
+_slot_states = {}
+_slot_states_lock = threading.Lock()
+_total_slots = 1
+_heartbeat_stop = threading.Event()
+
+"""
+Seconds after which the beat of a slot expires, unless it is sent again.
+"""
+BEAT_EXPIRE = 120
+
+"""
+How often (in seconds) the instance checks the Redis instance lock of a slot while waiting for submissions.
+"""
+INSTANCE_LOCK_CHECK_INTERVAL = 5
+
+"""
+Claim of the submission being processed, by the name of the slot. Claims are opaque strings
+made by the queue backend.
+"""
+_claims = {}
+
+
+class FilesNotFound(RuntimeError):
+    def __init__(self, *args, **kwargs):
+        RuntimeError.__init__(self, *args, **kwargs)
+
 
 def safe_ping():
     """
@@ -56,7 +116,7 @@ def _compare_instance_key(redis_value, exception_text):
 
 
 def set_instance_lock(fail_on_mismatch=True):
-    instance_lock_key = "instance_lock:{}".format(INSTANCE_NAME)
+    instance_lock_key = "instance_lock:{}".format(slot_name())
 
     if fail_on_mismatch:
         prev_uuid = rs_cli.get(instance_lock_key)
@@ -68,23 +128,219 @@ def set_instance_lock(fail_on_mismatch=True):
         _compare_instance_key(prev_uuid, 'Failed after acquiring lock.')
 
 
-def send_beat(state, uuid=None):
+def alive_key(name):
+    """
+    :return key of the beat of the slot called `name`, which exists only while the slot is alive
+    """
+    return REDIS_QUEUE_KEY + ":alive_workers:{}".format(name)
+
+
+def _beat(name, slot_state):
+    """
+    :return key, value and expiration time of the beat of the slot called `name`
+    """
     # TODO enforce some hard limit for a single test duration
-    data = {"state": state, "local_time_ms": int(time() * 1000), "current_uuid": uuid}
-    rs_cli.setex(REDIS_QUEUE_KEY + ":alive_workers:{}".format(INSTANCE_NAME), json.dumps(data), 120)
+    data = dict(slot_state, local_time_ms=int(time() * 1000), total_slots=_total_slots,
+                busy_slots=sum(1 for state in _slot_states.values() if state['state'] != 'idle'))
+    return alive_key(name), json.dumps(data), BEAT_EXPIRE
+
+
+def set_slot_state(state, uuid=None, stage=None):
+    """
+    Change the state of the current slot and publish it with the next flush of the reports.
+    """
+    with _slot_states_lock:
+        _slot_states[slot_name()] = {"state": state, "current_uuid": uuid, "stage": stage}
+        beat = _beat(slot_name(), _slot_states[slot_name()])
+
+    _queue_report(*beat)
+
+
+def clear_slot_state():
+    """
+    Stop sending the beats of the current slot, when it does not process submissions anymore.
+    """
+    with _slot_states_lock:
+        _slot_states.pop(slot_name(), None)
+
+
+def _run_heartbeat():
+    """
+    Publish the beats of all slots every HEARTBEAT_INTERVAL seconds and let the queue backend
+    take care of the claims of dead workers, until stop_heartbeat is called.
+    """
+    while True:
+        with _slot_states_lock:
+            beats = [_beat(name, slot_state) for name, slot_state in _slot_states.items()]
+
+        for beat in beats:
+            _queue_report(*beat)
+
+        try:
+            queue_backend().do_maintain(list(_claims.values()))
+        except RedisError:
+            logging.warning('Failed to maintain the claims of the submissions.', exc_info=True)
+
+        if _heartbeat_stop.wait(HEARTBEAT_INTERVAL):
+            return
+
+
+def start_heartbeat(total_slots):
+    """
+    Start the heartbeat thread of the instance, which serves `total_slots` submission slots.
+    :return the thread, which finishes after stop_heartbeat is called
+    """
+    global _total_slots
+    _total_slots = total_slots
+
+    thread = threading.Thread(target=_run_heartbeat, name='heartbeat', daemon=True)
+    thread.start()
+    return thread
+
+
+def stop_heartbeat():
+    """
+    Stop the heartbeat thread, which may be done only after all slots have finished their submissions,
+    otherwise their claims could be taken over by other workers.
+    """
+    _heartbeat_stop.set()
+
+
+def _queue_report(key, value, expire):
+    global _reporter
+
+    with _reports_cond:
+        _pending_reports[key] = (value, expire)
+
+        if not _reporter:
+            _reporter = threading.Thread(target=_run_reporter, name='reporter', daemon=True)
+            _reporter.start()
+
+        _reports_cond.notify()
+
+
+def _send_reports():
+    """
+    Send all pending reports in a single pipeline, `_flush_lock` has to be held, so that an older value
+    can not overwrite a newer one sent by another thread.
+    """
+    with _reports_cond:
+        reports = dict(_pending_reports)
+        _pending_reports.clear()
+
+    if not reports:
+        return
+
+    try:
+        pipe = rs_cli.pipeline(transaction=False)
+
+        for key, (value, expire) in reports.items():
+            pipe.set(key, value, ex=expire)
+
+        pipe.execute()
+    except ResponseError:
+        # Redis rejected the commands, sending the same reports again would not help
+        logging.error('Redis refused the partial status reports, they are dropped.', exc_info=True)
+    except RedisError:
+        logging.warning('Failed to report partial status due to the problem with Redis connectivity.', exc_info=True)
+
+        # the reports are retried with the next flush, unless they were replaced by newer ones meanwhile
+        with _reports_cond:
+            for key, report in reports.items():
+                _pending_reports.setdefault(key, report)
+
+
+def _run_reporter():
+    """
+    Flush the pending reports at most once per STATUS_REPORT_INTERVAL_MS, so the judging never waits for Redis.
+    """
+    while True:
+        with _reports_cond:
+            while not _pending_reports:
+                _reports_cond.wait()
+
+        with _flush_lock:
+            _send_reports()
+
+        sleep(STATUS_REPORT_INTERVAL_MS / 1000)
+
+
+def flush_reports():
+    """
+    Send the pending reports immediately, e.g. before the final result is published.
+    """
+    with _flush_lock:
+        _send_reports()
 
 
 def report_status(uuid, status, progress):
     """
     Report partial status to Redis, according to:
     Protocol: checking status of running job (wiki page)
+    The status is sent by the reporter thread together with the beat of the slot.
     """
-    try:
-        send_beat('checking', uuid)
-        data = json.dumps({'status': status, 'progress': progress}).encode('utf-8')
-        rs_cli.setex('status:{}'.format(uuid), data, 60)
-    except ConnectionError:
-        logging.warning('Failed to report partial status due to the problem with Redis connectivity.', exc_info=True)
+    set_slot_state('checking', uuid, status)
+    data = json.dumps({'status': status, 'progress': progress}).encode('utf-8')
+    _queue_report('status:{}'.format(uuid), data, 60)
+
+
+def queue_backend():
+    """
+    :return module of the queue backend selected by QUEUE_BACKEND
+    """
+    return plugin_loader.get('queue_backend', QUEUE_BACKEND)[0]
+
+
+def claim_submissions(count=1):
+    """
+    Atomically claim up to `count` submissions for the current slot, they stay claimed until
+    complete_submission is called, so they are not lost if the worker crashes.
+    :return claims and data of the submissions, without waiting if there are none
+    """
+    return queue_backend().do_claim(count)
+
+
+def complete_submission(uuid):
+    """
+    Release the claim of the submission processed by the current slot and remove its files,
+    after its result was sent. Until then, the files are kept for the case that the submission
+    is claimed again after a crash of the worker.
+    """
+    claim = _claims.pop(slot_name(), None)
+
+    if claim:
+        queue_backend().do_complete(claim)
+
+    remove_submission(uuid)
+
+
+def remove_submission(uuid):
+    """
+    Delete the files of the submission, unless they are persistent.
+    """
+    main_key = 'submission:{}'.format(uuid)
+
+    if not rs_cli.hget(main_key, 'options:persistent'):
+        rs_cli.delete(main_key)
+
+
+def requeue_claimed():
+    """
+    Make the submissions claimed by the current slot in the previous run of the instance available again.
+    """
+    queue_backend().do_recover()
+
+
+def wait_for_submissions():
+    """
+    Wait until new submissions may be available, the backends which can not be woken up are polled.
+    """
+    backend = queue_backend()
+
+    if hasattr(backend, 'do_wait'):
+        backend.do_wait(QUEUE_WAKEUP_TIMEOUT_SEC)
+    else:
+        sleep(QUEUE_POLL_INTERVAL_MS / 1000)
 
 
 def fetch_submission():
@@ -92,62 +348,142 @@ def fetch_submission():
     Fetch submission from the queue, according to:
     Protocol: uploading submission (wiki page)
     """
-    data = None
+    claimed = None
+    lock_checked = None
+    set_slot_state('idle')
 
-    while not data and not interrupted:
+    # the beat has to exist before the first claim, otherwise the claimed submissions could be requeued
+    # by the other workers as abandoned
+    flush_reports()
+
+    while not claimed and not interrupted:
         try:
-            set_instance_lock()
-            send_beat('idle')
-            keys = [REDIS_QUEUE_KEY + ":high", REDIS_QUEUE_KEY + ":medium", REDIS_QUEUE_KEY + ":low"]
-            data = rs_cli.blpop(keys, timeout=5)
+            if lock_checked is None or monotonic() - lock_checked >= INSTANCE_LOCK_CHECK_INTERVAL:
+                set_instance_lock()
+                lock_checked = monotonic()
+
+            claimed = claim_submissions()
+
+            if not claimed:
+                wait_for_submissions()
         except ConnectionError:
             _retry_ping()
 
     if interrupted:
         raise KeyboardInterrupt()
 
-    data_decoded = json.loads(data[1].decode('utf-8'))
-    s_uuid = str(data_decoded['uuid'])
-    queue_key = "{}:order".format(data[0].decode('utf-8'))
+    claim, data = claimed[0]
+    _claims[slot_name()] = claim
+    return json.loads(data)
+
+
+def _file_batches(main_key, fields):
+    """
+    Split the fields into batches, which are fetched by a single HMGET each, so that the batches
+    are not much larger than DOWNLOAD_BATCH_BYTES.
+    """
+    pipe = rs_cli.pipeline(transaction=False)
+
+    for field in fields:
+        pipe.hstrlen(main_key, field)
+
+    try:
+        sizes = pipe.execute()
+    except ResponseError:
+        # HSTRLEN is not supported by Redis older than 3.2, the batches are limited only by the number of files
+        sizes = [0] * len(fields)
+
+    batch = []
+    batch_bytes = 0
+
+    for field, size in zip(fields, sizes):
+        if batch and (batch_bytes + size > DOWNLOAD_BATCH_BYTES or len(batch) >= DOWNLOAD_BATCH_FILES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+
+        batch.append(field)
+        batch_bytes += size
+
+    if batch:
+        yield batch
+
+
+def _write_file(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
 
-    if not rs_cli.zrem(queue_key, s_uuid):
-        logging.warning('Failed to remove {} key from {}'.format(s_uuid, queue_key))
 
-    return data_decoded
+def _extract_archive(main_key, dest_path):
+    archive_path = dest_path + '.zip'
 
+    with open(archive_path, 'wb') as archive_file:
+        archive_file.write(rs_cli.hget(main_key, ARCHIVE_FIELD))
 
-def download_files(main_key, dest_path):
+    try:
+        with ZipFile(archive_path, 'r') as z:
+            z.extractall(dest_path)
+    except BadZipfile as e:
+        raise RuntimeError('Malformed archive in Redis key {}'.format(main_key)) from e
+    finally:
+        remove(archive_path)
+
+
+def download_files(main_key, dest_path, delete=True):
     """
     Download files stored in Redis key called `main_key` and extract
-    them into dest_path.
+    them into dest_path. The files are either stored in "file:<path>" fields
+    or all of them in a zip archive in the "archive:zip" field. The key is deleted
+    afterwards if `delete` is set, unless it has the "options:persistent" field.
     """
     try:
         rmtree(dest_path, ignore_errors=True)
-        sub_keys = rs_cli.hkeys(main_key)
+        makedirs(dest_path)
+
+        pipe = rs_cli.pipeline(transaction=False)
+        pipe.hkeys(main_key)
+        pipe.hget(main_key, 'options:persistent')
+        sub_keys, persistent = pipe.execute()
 
         if not len(sub_keys):
-            logging.error('Failed to download files from Redis, key does not exist.')
-            raise KeyError(main_key)
+            raise FilesNotFound('Failed to download files from Redis, key {} does not exist.'.format(main_key))
+
+        sub_keys = [key.decode('utf-8') for key in sub_keys]
+
+        if ARCHIVE_FIELD in sub_keys:
+            _extract_archive(main_key, dest_path)
+
+        files = {}
 
         for key in sub_keys:
-            key = key.decode('utf-8')
             m = match(r'^file:(.+)$', key)
 
             if m:
-                path = path_join(dest_path, m.group(1))
-                # in case of directories, if path is eg. foo/bar/code.cpp
-                try:
-                    makedirs(path_abspath(path_join(path, '..')))
-                except FileExistsError:
-                    pass
+                files[key] = path_join(dest_path, m.group(1))
+
+        # in case of directories, if path is eg. foo/bar/code.cpp
+        for directory in set(path_abspath(path_join(path, '..')) for path in files.values()):
+            makedirs(directory, exist_ok=True)
+
+        # the files of a batch are written while the next batch is being fetched
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WRITE_THREADS) as executor:
+            writes = []
 
-                with open(path, 'wb') as source_file:
-                    source_file.write(rs_cli.hget(main_key, key))
+            for batch in _file_batches(main_key, list(files.keys())):
+                contents = rs_cli.hmget(main_key, batch)
 
-        if not rs_cli.hget(main_key, 'options:persistent'):
+                for write in writes:
+                    write.result()
+
+                writes = [executor.submit(_write_file, files[key], content) for key, content in zip(batch, contents)]
+
+            for write in writes:
+                write.result()
+
+        if delete and not persistent:
             rs_cli.delete(main_key)
     except ConnectionError as e:
-        err = 'Failed to download files from Redis. Connection problem. {}'.format(e.message)
+        err = 'Failed to download files from Redis. Connection problem. {}'.format(e)
         logging.error(err)
         raise RuntimeError(err)
 
@@ -167,7 +503,8 @@ def download_project(uuid, dest_path):
     Protocol: uploading submission (wiki page)
     """
     main_key = 'submission:{}'.format(uuid)
-    return download_files(main_key, dest_path)
+    # the files are removed by complete_submission
+    return download_files(main_key, dest_path, delete=False)
 
 
 def upload_test_output(uuid, test_name, output_data, visibility):
@@ -186,16 +523,8 @@ def upload_test_output(uuid, test_name, output_data, visibility):
 def send_report_async(res):
     """
     Asynchronous reporting of final processing result. Turns `res` into JSON string and then
-    adds to the bottom (right) of the report_queue.
+    publishes it through the queue backend.
     """
     out = json.dumps(res._asdict(), indent=4, sort_keys=True)
     logging.info('Sending final report:\n%s', out)
-    count = rs_cli.publish("reports", out.encode('utf-8'))
-
-    if not count:
-        logging.error('Final report was published but no clients had received this message.')
-        return False
-    else:
-        logging.info('Final result was published successfully (recipients: %d).', count)
-
-    return True
+    return queue_backend().do_publish_result(out.encode('utf-8'))
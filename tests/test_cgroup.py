@@ -0,0 +1,68 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import cgroup
+
+CONTAINER_ID = 'abc123'
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+@pytest.fixture
+def cgroup_root(tmpdir, monkeypatch):
+    monkeypatch.setattr(cgroup, 'CGROUP_ROOT', str(tmpdir))
+    monkeypatch.setattr(cgroup, '_version', None)
+    return str(tmpdir)
+
+
+def test_v2(cgroup_root):
+    write_file(os.path.join(cgroup_root, 'cgroup.controllers'), 'cpu memory\n')
+    path = os.path.join(cgroup_root, 'system.slice', 'docker-{}.scope'.format(CONTAINER_ID))
+    write_file(os.path.join(path, 'memory.peak'), '1234\n')
+    write_file(os.path.join(path, 'cpu.stat'), 'usage_usec 5000\nuser_usec 4000\nsystem_usec 1000\n')
+
+    assert cgroup.cgroup_version() == 2
+    assert cgroup.container_cgroup(CONTAINER_ID, 'cpu') == path
+
+    stats = cgroup.read_stats(CONTAINER_ID)
+    assert stats['memory_stats']['max_usage'] == 1234
+    assert stats['cpu_stats']['cpu_usage']['total_usage'] == 5000000
+
+
+def test_v1(cgroup_root):
+    memory_path = os.path.join(cgroup_root, 'memory', 'docker', CONTAINER_ID)
+    cpu_path = os.path.join(cgroup_root, 'cpuacct', 'docker', CONTAINER_ID)
+    write_file(os.path.join(memory_path, 'memory.max_usage_in_bytes'), '4096\n')
+    write_file(os.path.join(cpu_path, 'cpuacct.usage'), '7000000\n')
+
+    assert cgroup.cgroup_version() == 1
+    assert cgroup.peak_reset_supported()
+
+    cgroup.reset_stats(CONTAINER_ID)
+
+    with open(os.path.join(memory_path, 'memory.max_usage_in_bytes')) as f:
+        assert f.read() == '0'
+
+    # the test uses memory and CPU after the reset
+    write_file(os.path.join(memory_path, 'memory.max_usage_in_bytes'), '2048\n')
+    write_file(os.path.join(cpu_path, 'cpuacct.usage'), '9500000\n')
+
+    stats = cgroup.read_stats(CONTAINER_ID)
+    assert stats['memory_stats']['max_usage'] == 2048
+    assert stats['cpu_stats']['cpu_usage']['total_usage'] == 2500000
+
+
+def test_missing_cgroup(cgroup_root):
+    with pytest.raises(cgroup.CgroupNotFound):
+        cgroup.container_cgroup(CONTAINER_ID, 'memory')
+
+    assert cgroup._cpu_usage(CONTAINER_ID) is None
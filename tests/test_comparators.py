@@ -0,0 +1,133 @@
+import io
+import math
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from env_provider.comparators import get_comparator, compare_numeric
+
+PAIRS = [
+    (b'', b''),
+    (b'', b'\n'),
+    (b'1 2 3\n', b'1 2 3\n'),
+    (b'1 2 3\n', b'1 2 3'),
+    (b'1 2 3 \n', b'1 2 3\n'),
+    (b'  1 2\t\n3\n', b'1 2\n3\n'),
+    (b'1 2\r\n3\r\n', b'1 2\n3\n'),
+    (b'1 2\r3\r', b'1 2\n3\n'),
+    (b'1  2\n', b'1 2\n'),
+    (b'1\n2\n', b'1 2\n'),
+    (b'1\n\n2\n', b'1\n2\n'),
+    (b'1 2\n\n', b'1 2\n'),
+    (b'abc\n', b'abd\n'),
+    (b'abc\n', b'ab c\n'),
+    (b'0.3333333\n', b'0.33333333\n'),
+    (b'0.3334\n', b'0.3333\n'),
+    (b'1e3 x\n', b'1000.0 x\n'),
+    (b'nan\n', b'nan\n'),
+    (b'1 2\n', b'1 2 3\n'),
+    (b'x\x0b\x0cy\t\n', b'x\x0b\x0cy\n'),
+]
+
+
+def split_at(data, offset):
+    return [chunk for chunk in (data[:offset], data[offset:]) if chunk]
+
+
+def legacy_lines(data1, data2):
+    """
+    The original comparison of the file environment, line by line in the text mode.
+    """
+    f1 = io.StringIO(data1.decode(), newline=None)
+    f2 = io.StringIO(data2.decode(), newline=None)
+
+    while True:
+        line1 = f1.readline()
+        line2 = f2.readline()
+
+        if not line1 and line2 or line1 and not line2:
+            return False
+
+        if not line1 and not line2:
+            return True
+
+        if line1.strip() != line2.strip():
+            return False
+
+
+def legacy_numeric(data1, data2):
+    tokens1 = data1.split()
+    tokens2 = data2.split()
+
+    if len(tokens1) != len(tokens2):
+        return False
+
+    for token1, token2 in zip(tokens1, tokens2):
+        try:
+            value1, value2 = float(token1), float(token2)
+        except ValueError:
+            if token1 != token2:
+                return False
+
+            continue
+
+        if math.isnan(value1) and math.isnan(value2):
+            continue
+
+        if abs(value1 - value2) > 1e-6 + 1e-6 * abs(value2):
+            return False
+
+    return True
+
+
+EXPECTED = {
+    "exact": lambda data1, data2: data1 == data2,
+    "line_endings": lambda data1, data2: io.StringIO(data1.decode(), newline=None).read()
+                                         == io.StringIO(data2.decode(), newline=None).read(),
+    "whitespace": legacy_lines,
+    "tokens": lambda data1, data2: data1.split() == data2.split(),
+    "numeric": legacy_numeric
+}
+
+
+def check_mode(mode):
+    comparator = get_comparator(mode)
+
+    for data1, data2 in PAIRS:
+        expected = EXPECTED[mode](data1, data2)
+
+        for offset1 in range(len(data1) + 1):
+            for offset2 in range(len(data2) + 1):
+                result = comparator(split_at(data1, offset1), split_at(data2, offset2))
+                assert bool(result) == expected, (mode, data1, offset1, data2, offset2)
+
+
+def test_exact():
+    check_mode('exact')
+
+
+def test_line_endings():
+    check_mode('line_endings')
+
+
+def test_whitespace():
+    check_mode('whitespace')
+
+
+def test_tokens():
+    check_mode('tokens')
+
+
+def test_numeric():
+    check_mode('numeric')
+
+
+def test_numeric_mismatch_position():
+    result = compare_numeric([b'1 2.0000001 3', b' 5\n'], [b'1 2 3 4\n'])
+    assert not result
+    assert 'token 3' in result.message and '"5" instead of "4"' in result.message
+
+    result = compare_numeric([b'1 2'], [b'1 2 3\n'])
+    assert not result
+    assert 'fewer' in result.message and 'first 2 tokens' in result.message
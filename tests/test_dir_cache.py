@@ -0,0 +1,88 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from dir_cache import DirectoryCache
+
+
+def fill_bytes(size):
+    def fill(path):
+        with open(os.path.join(path, 'data'), 'wb') as f:
+            f.write(b'x' * size)
+
+    return fill
+
+
+def make_cache(tmpdir, max_bytes=10):
+    return DirectoryCache('test', str(tmpdir), max_bytes)
+
+
+def test_evicts_least_recently_used(tmpdir):
+    cache = make_cache(tmpdir)
+
+    for key in ['a', 'b']:
+        cache.store(key, fill_bytes(5))
+        cache.release(key)
+
+    # "a" becomes the most recently used entry
+    cache.lookup('a')
+    cache.release('a')
+
+    cache.store('c', fill_bytes(5))
+    cache.release('c')
+
+    assert cache.lookup('b') is None
+    assert cache.lookup('a') and cache.lookup('c')
+    assert not os.path.exists(cache.path('b'))
+
+
+def test_pinned_entries_are_not_evicted(tmpdir):
+    cache = make_cache(tmpdir)
+
+    cache.store('a', fill_bytes(5))
+    cache.store('b', fill_bytes(5))
+    cache.release('b')
+
+    cache.store('c', fill_bytes(5))
+
+    assert os.path.isdir(cache.path('a'))
+    assert not os.path.exists(cache.path('b'))
+
+    # everything is pinned, so the cache stays over its limit until the entries are released
+    cache.store('d', fill_bytes(5))
+    assert cache.stats()['bytes'] == 15
+
+    for key in ['a', 'c', 'd']:
+        cache.release(key)
+
+    assert cache.stats()['bytes'] == 10
+    assert not os.path.exists(cache.path('a'))
+
+
+def test_discard_keeps_entry_pinned_by_others(tmpdir):
+    cache = make_cache(tmpdir)
+
+    cache.store('a', fill_bytes(5))
+    cache.lookup('a')
+
+    cache.discard('a')
+    assert os.path.isdir(cache.path('a'))
+    assert cache.stats()['entries'] == 1
+
+    cache.discard('a')
+    assert not os.path.exists(cache.path('a'))
+    assert cache.stats() == {"hits": 1, "misses": 0, "entries": 0, "bytes": 0}
+
+
+def test_index_is_loaded_from_disk(tmpdir):
+    cache = make_cache(tmpdir)
+    cache.store('a', fill_bytes(5))
+    cache.release('a')
+
+    os.makedirs(os.path.join(str(tmpdir), '.tmp-leftover'))
+
+    cache = make_cache(tmpdir)
+    assert cache.lookup('a') == cache.path('a')
+    assert cache.stats()['bytes'] == 5
+    assert not os.path.exists(os.path.join(str(tmpdir), '.tmp-leftover'))
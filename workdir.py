@@ -1,13 +1,69 @@
-from os.path import join as path_join
-from os import makedirs
-from shutil import rmtree
+import threading
+from os.path import join as path_join, isdir, islink
+from os import makedirs, listdir, remove
+from shutil import rmtree, copytree, copy
 from worker_conf import INSTANCE_NAME
 
+"""
+Submission slot which is being served by the current thread.
+"""
+_slot = threading.local()
+
+
+def set_slot(slot):
+    _slot.index = slot
+
+
+def get_slot():
+    return getattr(_slot, 'index', 0)
+
+
+def slot_name():
+    """
+    Name under which the current slot is known outside of the worker, the first
+    slot is known under the plain instance name.
+    """
+    if not get_slot():
+        return INSTANCE_NAME
+
+    return '{}-slot{}'.format(INSTANCE_NAME, get_slot())
+
 
 def internal_path(sub_path):
+    """
+    Path inside of the instance's internal directory. The "work" tree is private
+    for each submission slot, everything else is shared by the whole instance.
+    """
+    if get_slot() and (sub_path == 'work' or sub_path.startswith('work/')):
+        sub_path = 'work-{}{}'.format(get_slot(), sub_path[len('work'):])
+
     return path_join('/tmp/algochecker', INSTANCE_NAME, sub_path)
 
 
 def recreate_workdir():
     rmtree(internal_path('work'), ignore_errors=True)
     makedirs(internal_path('work'))
+
+
+def clear_directory(dir_path):
+    """
+    Remove the whole content of the directory, but keep the directory itself
+    as it may be bind-mounted into an already running container.
+    """
+    for entry in listdir(dir_path):
+        entry_path = path_join(dir_path, entry)
+
+        if isdir(entry_path) and not islink(entry_path):
+            rmtree(entry_path)
+        else:
+            remove(entry_path)
+
+
+def copy_directory_content(src_path, dest_path):
+    for entry in listdir(src_path):
+        entry_path = path_join(src_path, entry)
+
+        if isdir(entry_path):
+            copytree(entry_path, path_join(dest_path, entry))
+        else:
+            copy(entry_path, path_join(dest_path, entry))
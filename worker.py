@@ -2,9 +2,12 @@
 import logging
 import signal
 import sys
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from os import makedirs, walk
 from os.path import join, basename
+from queue import Queue
 from shutil import make_archive
 from traceback import format_exc
 
@@ -15,13 +18,13 @@ from requests import ConnectionError
 
 from container import docker_cli, check_lost_containers, check_image_dependencies, PluginError, check_leftover_networks
 from logo import print_header
-from container import shrink_logs, safe_plugin_call
-from package import get_package, prune_unused_packages, parse_config
+from container import shrink_logs, safe_plugin_call, pool_drain, pool_stats, wait_for_reaper
+from package import get_package, prune_unused_packages, parse_config, release_package
 import plugin_loader
 import task_queue
 from tuples import FinalResult
-from workdir import internal_path, recreate_workdir
-from worker_conf import INSTANCE_NAME, DEBUG_MODE, LOG_FORMAT, LOG_DATEFMT
+from workdir import internal_path, recreate_workdir, set_slot, get_slot, slot_name
+from worker_conf import DEBUG_MODE, LOG_FORMAT, LOG_DATEFMT, CONTAINER_POOL_SIZE, TEST_SLOTS, SUBMISSION_SLOTS
 
 
 def setup_logging():
@@ -70,6 +73,15 @@ def perform_compilation(s_data, pack):
     return compile_success, compile_res.message
 
 
+def teardown_runners():
+    """
+    Let the runners destroy anything what they were keeping between the tests of the submission
+    """
+    for runner in plugin_loader.get_all('runners').values():
+        if hasattr(runner, 'do_teardown'):
+            safe_plugin_call(runner, lambda: runner.do_teardown())
+
+
 def perform_run(s_data, pack):
     """
     Run all tests via env provider plugin and evaluate them
@@ -79,20 +91,45 @@ def perform_run(s_data, pack):
                                                   pack.config['evaluator']['name'], pack.config['evaluator'])
 
     test_units = safe_plugin_call(envpr, lambda: envpr.do_create_test_units(s_data, envpr_conf, pack))
-    results = []
+    finished = []
 
-    for test_unit in test_units:
-        logging.info('Processing test ' + test_unit.name + '...')
+    # each slot has its own runner location, so the tests running at the same time are isolated
+    free_slots = Queue()
 
-        task_queue.report_status(s_data['uuid'], 'testing', 20 + int(len(results) * 80 / len(test_units)))
+    for slot in range(1 if DEBUG_MODE else TEST_SLOTS):
+        free_slots.put(slot)
 
-        test_res = safe_plugin_call(envpr, lambda: envpr.do_run_test(s_data, envpr_conf, pack, test_unit))
-        results.append(test_res._asdict())
+    submission_slot = get_slot()
 
-        if DEBUG_MODE:
-            logging.info('Finished test {}'.format(test_unit.name))
-            logging.info('Result: {}'.format(test_res._asdict()))
-            input('Press <ENTER> to continue.')
+    def run_test_unit(test_unit):
+        # test threads work within the workdir of the submission slot
+        set_slot(submission_slot)
+        slot = free_slots.get()
+
+        try:
+            logging.info('Processing test {} (slot {})...'.format(test_unit.name, slot))
+
+            task_queue.report_status(s_data['uuid'], 'testing', 20 + int(len(finished) * 80 / len(test_units)))
+
+            test_res = safe_plugin_call(envpr, lambda: envpr.do_run_test(s_data, envpr_conf, pack, test_unit,
+                                                                         slot=slot))
+            finished.append(test_unit.name)
+
+            if DEBUG_MODE:
+                logging.info('Finished test {}'.format(test_unit.name))
+                logging.info('Result: {}'.format(test_res._asdict()))
+                input('Press <ENTER> to continue.')
+        finally:
+            free_slots.put(slot)
+
+        return test_res._asdict()
+
+    try:
+        with ThreadPoolExecutor(max_workers=free_slots.qsize()) as executor:
+            # results are collected in the order of test units, no matter which one finished first
+            results = list(executor.map(run_test_unit, test_units))
+    finally:
+        teardown_runners()
 
     score, results = safe_plugin_call(evaluator, lambda: evaluator.do_process_results(evaluator_conf, results))
     return score, results
@@ -110,7 +147,19 @@ def process_submission(s_data):
     recreate_workdir()
 
     pack = get_package(**s_data['package'])
-    pack = parse_config(pack, s_data['config'] if 'config' in s_data else None)
+
+    try:
+        return judge_submission(s_data, parse_config(pack, s_data['config'] if 'config' in s_data else None))
+    finally:
+        # the package may be evicted from the cache only when it is not used anymore
+        release_package(pack)
+
+
+def judge_submission(s_data, pack):
+    """
+    Compile and test the submission with the package already loaded.
+    """
+    s_uuid = s_data['uuid']
 
     compile_result, logs = perform_compilation(s_data, pack)
 
@@ -172,25 +221,67 @@ def main():
     plugin_loader.load_namespace('env_provider')
     plugin_loader.load_namespace('runners')
     plugin_loader.load_namespace('evaluators')
+    plugin_loader.load_namespace('queue_backend')
 
     if not check_connections():
         logging.error('Failed to establish the connections, exiting...')
         sys.exit(2)
 
-    check_lost_containers()
+    pool_drain()
+    check_lost_containers(all_slots=True)
     check_leftover_networks()
     check_image_dependencies()
     prune_unused_packages()
 
+    check_ptrace_scope()
+    check_cr_shell_endings()
+
+    logging.info('Ready! Starting worker...')
+
+    slots = 1 if DEBUG_MODE else SUBMISSION_SLOTS
+    heartbeat = task_queue.start_heartbeat(slots)
+    threads = [threading.Thread(target=run_slot, args=(slot,), name='slot-{}'.format(slot))
+               for slot in range(1, slots)]
+
+    for thread in threads:
+        thread.start()
+
+    # the first slot is served by the main thread
+    run_slot(0)
+
+    for thread in threads:
+        thread.join()
+
+    # the beats are needed until the last submission is finished
+    task_queue.stop_heartbeat()
+    heartbeat.join()
+    logging.warning('Program interrupted, will now stop.')
+    pool_drain()
+    wait_for_reaper(all_slots=True)
+    sys.exit(0)
+
+
+def run_slot(slot):
+    """
+    Serve submissions in the given slot until the worker is interrupted.
+    """
+    set_slot(slot)
+
+    try:
+        serve_slot()
+    finally:
+        # a slot which does not work anymore must not look alive, so its claims can be taken over
+        task_queue.clear_slot_state()
+
+
+def serve_slot():
     # write the random UUID of current instance to the instance lock
     # if it would be overridden during worker execution, then it means
     # that the second worker was started with the same instance name
     task_queue.set_instance_lock(False)
 
-    check_ptrace_scope()
-    check_cr_shell_endings()
-
-    logging.info('Ready! Starting worker...')
+    # the slot is ours now, so the submissions it left unfinished can not be processed by anybody else
+    task_queue.requeue_claimed()
 
     while True:
         if DEBUG_MODE:
@@ -200,8 +291,7 @@ def main():
         try:
             s_data = task_queue.fetch_submission()
         except KeyboardInterrupt as e:
-            logging.warning('Program interrupted, will now stop.')
-            sys.exit(0)
+            return
 
         started_time = int(time.time() * 1000)
 
@@ -239,7 +329,8 @@ def main():
             make_archive(join(internal_path('error_report'), report_name), 'zip', internal_path('work'))
             logging.error('IMPORTANT! Work directory was archived in order to allow further inspection.')
             logging.error('-----------------------------')
-        except RuntimeError:
+        except Exception:
+            # the slot has to survive anything, otherwise its claim would stay in the queue forever
             trace_str = format_exc(20)
             logging.exception('An error occurred while processing submission.')
             # if an error was caused inside docker container, then we
@@ -249,19 +340,30 @@ def main():
 
         finished_time = int(time.time() * 1000)
 
+        if CONTAINER_POOL_SIZE:
+            logging.info('Container pool: {hits} hits, {misses} misses, {idle} idle.'.format(**pool_stats()))
+
         res = res._replace(
-            checked_by=INSTANCE_NAME,
+            checked_by=slot_name(),
             time_stats={
                 "started_ms": started_time,
                 "finished_ms": finished_time,
                 "took_time_ms": finished_time - started_time
             })
 
+        # no container of the submission may outlive the publication of its result
+        wait_for_reaper()
+
+        # the final status has to be in Redis before the result is published
+        task_queue.flush_reports()
+
         if 'async_report' in s_data['features']:
             task_queue.send_report_async(res)
         else:
             logging.error('Synchronous result reporting is not longer supported. Failed to send report.')
 
+        task_queue.complete_submission(s_data['uuid'])
+
 
 if __name__ == "__main__":
     main()